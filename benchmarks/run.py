@@ -0,0 +1,183 @@
+"""Benchmark every wit command on a synthetic repository.
+
+A repository with a configurable shape (files, depth, size distribution, history length)
+is generated inside a throwaway HOME, every command is run in a fresh interpreter and its
+wall time, peak RSS and bytes read / written are recorded. Usage:
+
+    python benchmarks/run.py [--files N] [--depth N] [--sizes lognormal|uniform|fixed]
+                             [--mean-size BYTES] [--history N] [--change-ratio R]
+                             [--seed N] [--output results.json]
+    python benchmarks/run.py --compare old.json new.json [--threshold 1.10]
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+WIT_SCRIPT = Path(__file__).resolve().parent.parent / "wit.py"
+# Runs wit as __main__ and reports the I/O of the process itself, which /proc loses at exit
+RUNNER = """
+import atexit, json, os, runpy, sys
+def report():
+    io_counters = {}
+    try:
+        with open("/proc/self/io") as io_file:
+            io_counters = dict(line.split(": ") for line in io_file.read().splitlines())
+    except OSError:
+        pass
+    with open(os.environ["WIT_BENCH_REPORT"], "w") as report_file:
+        json.dump({key: int(value) for key, value in io_counters.items()}, report_file)
+atexit.register(report)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def get_file_size(distribution: str, mean_size: int, rng: random.Random) -> int:
+    if distribution == "fixed":
+        return mean_size
+    if distribution == "uniform":
+        return rng.randint(0, 2 * mean_size)
+    return int(rng.lognormvariate(0, 1) * mean_size / 1.6487)  # e ** 0.5, mean of lognormvariate(0, 1)
+
+
+def write_file(path: Path, size: int, rng: random.Random) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    line = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz ") for _ in range(79)) + "\n"
+    with open(str(path), "w") as file:
+        file.write((line * (size // 80 + 1))[:size])
+
+
+def generate_repository(repo: Path, files: int, depth: int, distribution: str, mean_size: int, rng: random.Random) -> list:
+    paths = []
+    for file_number in range(files):
+        directories = [f"dir{rng.randrange(8)}" for _ in range(rng.randint(0, depth))]
+        path = repo.joinpath(*directories, f"file{file_number}.txt")
+        write_file(path, get_file_size(distribution, mean_size, rng), rng)
+        paths.append(path)
+    return paths
+
+
+def change_files(paths: list, change_ratio: float, rng: random.Random) -> None:
+    for path in rng.sample(paths, max(1, int(len(paths) * change_ratio))):
+        with open(str(path), "a") as file:
+            file.write(f"change {rng.random()}\n")
+
+
+def run_command(args: list, home: Path, cwd: Path) -> dict:
+    report_path = home / "bench_report.json"
+    env = dict(os.environ, HOME=str(home), MPLBACKEND="Agg", WIT_BENCH_REPORT=str(report_path))
+    start_time = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", RUNNER, str(WIT_SCRIPT)] + args, cwd=str(cwd), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _pid, _status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start_time
+    io_counters = json.loads(report_path.read_text()) if report_path.exists() else {}
+    return {
+        "wall_s": wall_time,
+        "max_rss_kb": rusage.ru_maxrss,  # KB on linux
+        "read_bytes": io_counters.get("rchar"),
+        "written_bytes": io_counters.get("wchar"),
+    }
+
+
+def summarize(runs: list) -> dict:
+    walls = [run["wall_s"] for run in runs]
+    return {
+        "runs": len(runs),
+        "wall_s_median": statistics.median(walls),
+        "wall_s_min": min(walls),
+        "max_rss_kb": max(run["max_rss_kb"] for run in runs),
+        "read_bytes": statistics.median(run["read_bytes"] for run in runs) if runs[0]["read_bytes"] is not None else None,
+        "written_bytes": statistics.median(run["written_bytes"] for run in runs) if runs[0]["written_bytes"] is not None else None,
+    }
+
+
+def get_wit_version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=str(WIT_SCRIPT.parent), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def benchmark(options: argparse.Namespace) -> dict:
+    rng = random.Random(options.seed)
+    results = {}
+
+    def measure(name: str, args: list, cwd: Path) -> None:
+        results.setdefault(name, []).append(run_command(args, home, cwd))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        home = Path(temp_dir)
+        repo = home / "repo"
+        paths = generate_repository(repo, options.files, options.depth, options.sizes, options.mean_size, rng)
+        measure("init", ["init"], home)
+        measure("add", ["add", str(repo)], repo)
+        measure("commit", ["commit", "commit 0"], repo)
+        measure("status clean", ["status"], repo)
+        measure("branch", ["branch", "bench"], repo)
+        for commit_number in range(1, options.history + 1):
+            change_files(paths, options.change_ratio, rng)
+            measure("status dirty", ["status"], repo)
+            measure("add changed", ["add", str(repo)], repo)
+            measure("commit", ["commit", f"commit {commit_number}"], repo)
+        measure("checkout branch", ["checkout", "bench"], repo)
+        change_files(paths, options.change_ratio, rng)
+        measure("add changed", ["add", str(repo)], repo)
+        measure("commit", ["commit", "on bench"], repo)
+        measure("checkout master", ["checkout", "master"], repo)
+        measure("merge", ["merge", "bench"], repo)
+        measure("log", ["log", "--graph"], repo)
+        measure("gc", ["gc"], repo)
+        measure("checkout packed", ["checkout", "bench"], repo)
+        measure("repack", ["repack"], repo)
+    return {
+        "wit_version": get_wit_version(),
+        "python": sys.version.split()[0],
+        "config": vars(options),
+        "results": {name: summarize(runs) for name, runs in results.items()},
+    }
+
+
+def compare(old_path: str, new_path: str, threshold: float) -> int:
+    """Print new / old ratios; the exit code is 1 when a command got slower than threshold."""
+    old_results = json.loads(Path(old_path).read_text())["results"]
+    new_results = json.loads(Path(new_path).read_text())["results"]
+    regressions = 0
+    for name, new_result in new_results.items():
+        if name not in old_results:
+            continue
+        ratio = new_result["wall_s_median"] / max(old_results[name]["wall_s_median"], 1e-9)
+        flag = "REGRESSION" if ratio > threshold else ""
+        regressions += bool(flag)
+        print(f"{name:<18} {old_results[name]['wall_s_median'] * 1000:9.1f} ms -> {new_result['wall_s_median'] * 1000:9.1f} ms  x{ratio:5.2f} {flag}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark wit commands on a synthetic repository")
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--sizes", choices=("lognormal", "uniform", "fixed"), default="lognormal")
+    parser.add_argument("--mean-size", type=int, default=4096)
+    parser.add_argument("--history", type=int, default=5)
+    parser.add_argument("--change-ratio", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--threshold", type=float, default=1.10)
+    options = parser.parse_args()
+    if options.compare:
+        sys.exit(compare(options.compare[0], options.compare[1], options.threshold))
+    options_to_record = argparse.Namespace(**{key: value for key, value in vars(options).items() if key not in ("output", "compare", "threshold")})
+    report = json.dumps(benchmark(options_to_record), indent=2)
+    if options.output:
+        Path(options.output).write_text(report + "\n")
+    else:
+        print(report)
@@ -0,0 +1,73 @@
+"""Cold start time of every wit subcommand.
+
+Every run is a new interpreter, like a user typing the command, inside a throwaway HOME
+with a small repository. Usage:
+
+    python benchmarks/startup.py [--repeat N] [--json]
+"""
+import json
+import os
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+WIT_SCRIPT = Path(__file__).resolve().parent.parent / "wit.py"
+REPEAT = 10
+COMMANDS = [
+    ["status"],
+    ["add", "{repo}/a.txt"],
+    ["commit", "startup benchmark"],
+    ["branch", "startup"],
+    ["checkout", "master"],
+    ["graph"],
+    ["gc"],
+]
+
+
+def run(args: list, home: Path, cwd: Path) -> float:
+    env = dict(os.environ, HOME=str(home), MPLBACKEND="Agg")
+    start_time = time.perf_counter()
+    subprocess.run(args, cwd=str(cwd), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    return time.perf_counter() - start_time
+
+
+def create_repository(home: Path) -> Path:
+    repo = home / "repo"
+    repo.mkdir()
+    (repo / "a.txt").write_text("startup\n")
+    run([sys.executable, str(WIT_SCRIPT), "init"], home, home)
+    run([sys.executable, str(WIT_SCRIPT), "add", str(repo)], home, repo)
+    run([sys.executable, str(WIT_SCRIPT), "commit", "first"], home, repo)
+    return repo
+
+
+def measure(repeat: int) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        home = Path(temp_dir)
+        repo = create_repository(home)
+        baselines = {
+            "python": [sys.executable, "-c", "pass"],
+            "import wit": [sys.executable, "-c", f"import sys; sys.path.insert(0, {str(WIT_SCRIPT.parent)!r}); import wit"],
+        }
+        for name, args in baselines.items():
+            results[name] = [run(args, home, repo) for _ in range(repeat)]
+        for command in COMMANDS:
+            args = [sys.executable, str(WIT_SCRIPT)] + [arg.format(repo=repo) for arg in command]
+            results[command[0]] = [run(args, home, repo) for _ in range(repeat)]
+    return {name: {"min_ms": min(times) * 1000, "median_ms": statistics.median(times) * 1000} for name, times in results.items()}
+
+
+if __name__ == "__main__":
+    argvs = sys.argv
+    repeat = int(argvs[argvs.index("--repeat") + 1]) if "--repeat" in argvs else REPEAT
+    timings = measure(repeat)
+    if "--json" in argvs:
+        print(json.dumps(timings, indent=2))
+    else:
+        for name, timing in timings.items():
+            print(f"{name:<12} min {timing['min_ms']:7.1f} ms   median {timing['median_ms']:7.1f} ms")
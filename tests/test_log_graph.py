@@ -0,0 +1,91 @@
+"""Rendering of wit log --graph on small commit graphs, without a repository on disk."""
+from pathlib import Path
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import wit  # noqa: E402
+
+
+@pytest.fixture
+def commit_graph():
+    """Fill the commit graph cache with {commit id: (generation, [parent ids])}."""
+    def fill(graph: dict) -> None:
+        wit._commit_graph.clear()
+        wit._commit_graph.update(graph)
+    yield fill
+    wit._commit_graph.clear()
+
+
+def render(start_ids: list) -> str:
+    return "\n".join(line.rstrip() for line in wit.iter_log_lines(start_ids, True, {}, oneline=True))
+
+
+def test_straight_history(commit_graph):
+    commit_graph({"R": (1, []), "A": (2, ["R"]), "B": (3, ["A"])})
+    assert render(["B"]) == "*  B\n*  A\n*  R"
+
+
+def test_fork(commit_graph):
+    commit_graph({"R": (1, []), "A": (2, ["R"]), "B": (2, ["R"])})
+    assert render(["A", "B"]) == "\n".join([
+        "*  A",
+        "| *  B",
+        "|/",
+        "*  R",
+    ])
+
+
+def test_merge_opens_a_column_next_to_the_commit(commit_graph):
+    commit_graph({"R": (1, []), "A": (2, ["R"]), "B": (2, ["R"]), "Q": (2, ["R"]), "P": (3, ["A", "B"]), "T": (4, ["P", "Q"])})
+    assert render(["T"]) == "\n".join([
+        "*  T",
+        "|\\",
+        "* |  P",
+        "|\\ \\",
+        "* | |  A",
+        "| * |  B",
+        "|/ /",
+        "| *  Q",
+        "|/",
+        "*  R",
+    ])
+
+
+def test_octopus_merge(commit_graph):
+    commit_graph({"R": (1, []), "A": (2, ["R"]), "B": (2, ["R"]), "C": (2, ["R"]), "M": (3, ["A", "B", "C"])})
+    assert render(["M"]) == "\n".join([
+        "*  M",
+        "|\\ \\",
+        "* | |  A",
+        "| * |  B",
+        "|/ /",
+        "| *  C",
+        "|/",
+        "*  R",
+    ])
+
+
+def test_column_joins_a_column_left_of_it(commit_graph):
+    commit_graph({"R": (1, []), "A": (2, ["R"]), "B": (2, ["R"]), "C": (3, ["R"]), "M": (4, ["A", "B"])})
+    assert render(["M", "C"]) == "\n".join([
+        "*  M",
+        "|\\",
+        "| | *  C",
+        "* | |  A",
+        "|_|/",
+        "| *  B",
+        "|/",
+        "*  R",
+    ])
+
+
+@pytest.mark.parametrize("edges, width, connector", [
+    ([(0, 0), (1, 0)], 2, "|/"),
+    ([(0, 0), (0, 1), (1, 2)], 3, "|\\ \\"),
+    ([(0, 0), (1, 1), (2, 2), (3, 0)], 4, "|_|_|/"),
+    ([(0, 0), (0, 2)], 3, "|_ \\"),
+])
+def test_graph_connector(edges, width, connector):
+    assert wit.get_graph_connector(edges, width) == connector
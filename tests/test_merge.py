@@ -0,0 +1,78 @@
+"""Line matching and three way merge of file contents, and the pack delta codec."""
+from pathlib import Path
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import wit  # noqa: E402
+
+
+def test_line_matches_are_a_longest_common_subsequence():
+    lines, other_lines = list("abcabba"), list("cbabac")
+    matches = wit.get_line_matches(lines, other_lines)
+    assert len(matches) == 4  # the length of an LCS of the two
+    assert all(lines[line_index] == other_lines[other_index] for line_index, other_index in matches)
+    assert matches == sorted(matches)
+    assert len({other_index for _line_index, other_index in matches}) == len(matches)
+
+
+@pytest.mark.parametrize("lines, other_lines, matches", [
+    ([], [], []),
+    (["a\n"], [], []),
+    (["a\n", "b\n"], ["a\n", "b\n"], [(0, 0), (1, 1)]),
+    (["a\n", "b\n", "c\n"], ["a\n", "x\n", "c\n"], [(0, 0), (2, 2)]),
+    (["a\n", "c\n"], ["a\n", "b\n", "c\n"], [(0, 0), (1, 2)]),
+])
+def test_line_matches(lines, other_lines, matches):
+    assert wit.get_line_matches(lines, other_lines) == matches
+
+
+def test_merge_of_changes_in_different_regions():
+    merged, has_conflict = wit.merge_file_content(b"a\nb\nc\n", b"A\nb\nc\n", b"a\nb\nC\n", "feature")
+    assert merged == b"A\nb\nC\n"
+    assert not has_conflict
+
+
+def test_merge_of_the_same_change_on_both_sides():
+    merged, has_conflict = wit.merge_file_content(b"a\nb\n", b"a\nB\n", b"a\nB\n", "feature")
+    assert merged == b"a\nB\n"
+    assert not has_conflict
+
+
+def test_merge_conflict_markers():
+    merged, has_conflict = wit.merge_file_content(b"a\nb\nc\n", b"a\nX\nc\n", b"a\nY\nc\n", "feature")
+    assert merged == b"a\n<<<<<<< HEAD\nX\n=======\nY\n>>>>>>> feature\nc\n"
+    assert has_conflict
+
+
+def test_merge_conflict_without_final_newline():
+    merged, has_conflict = wit.merge_file_content(b"a\nb", b"a\nX", b"a\nY", "feature")
+    assert merged == b"a\n<<<<<<< HEAD\nX\n=======\nY\n>>>>>>> feature\n"
+    assert has_conflict
+
+
+def test_binary_files_conflict():
+    merged, has_conflict = wit.merge_file_content(b"\0a", b"\0b", b"\0c", "feature")
+    assert merged == b"\0b"
+    assert has_conflict
+
+
+@pytest.mark.parametrize("base, target", [
+    (b"", b""),
+    (b"", b"new content"),
+    (b"x" * 100, b""),
+    (bytes(range(256)) * 4, bytes(range(256)) * 4),
+    (bytes(range(256)) * 4, b"head" + bytes(range(256)) * 2 + b"middle" + bytes(range(128)) + b"tail"),
+    (b"short", b"short but longer"),
+])
+def test_delta_round_trip(base, target):
+    assert wit.apply_delta(base, wit.create_delta(base, target)) == target
+
+
+def test_delta_copies_shared_blocks():
+    base = bytes(range(256)) * 16
+    target = base[:2048] + b"inserted" + base[2048:]
+    delta = wit.create_delta(base, target)
+    assert len(delta) < len(target) // 10
+    assert wit.apply_delta(base, delta) == target
@@ -0,0 +1,51 @@
+"""Sparse checkout patterns: the working root, nested paths and globs."""
+from pathlib import Path
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import wit  # noqa: E402
+
+
+@pytest.mark.parametrize("root", ["", ".", "/"])
+def test_working_root_matches_everything(root):
+    patterns = wit.compile_sparse_patterns([root])
+    for relative_path in ("a.txt", "src/deep/b.txt", ".hidden"):
+        assert wit.is_sparse_path(relative_path, patterns)
+    assert wit.may_contain_sparse_paths("src", patterns)
+    assert wit.may_contain_sparse_paths("src/deep", patterns)
+
+
+def test_nested_path():
+    patterns = wit.compile_sparse_patterns(["src/lib"])
+    assert wit.is_sparse_path("src/lib", patterns)
+    assert wit.is_sparse_path("src/lib/a.py", patterns)
+    assert wit.is_sparse_path("src/lib/deep/b.py", patterns)
+    assert not wit.is_sparse_path("src/library.py", patterns)
+    assert not wit.is_sparse_path("src/app/a.py", patterns)
+    assert not wit.is_sparse_path("a.txt", patterns)
+    assert wit.may_contain_sparse_paths("src", patterns)
+    assert wit.may_contain_sparse_paths("src/lib/deep", patterns)
+    assert not wit.may_contain_sparse_paths("src/app", patterns)
+    assert not wit.may_contain_sparse_paths("docs", patterns)
+
+
+def test_glob_path():
+    patterns = wit.compile_sparse_patterns(["src/*/tests"])
+    assert wit.is_sparse_path("src/lib/tests/test_a.py", patterns)
+    assert not wit.is_sparse_path("src/lib/a.py", patterns)
+    assert wit.may_contain_sparse_paths("src/lib", patterns)
+    assert not wit.may_contain_sparse_paths("docs", patterns)
+
+
+def test_empty_sparse_file_is_a_full_checkout(tmp_path):
+    wit_path = tmp_path / ".wit"
+    wit_path.mkdir()
+    old_wit_path = wit.WIT_PATH
+    wit.use_repository(wit_path)
+    try:
+        wit.SPARSE_PATH.write_text("\n")
+        assert wit.load_sparse_patterns() is None
+    finally:
+        wit.use_repository(old_wit_path)
@@ -1,84 +1,253 @@
+import atexit
+from contextlib import contextmanager
 import datetime
-from distutils.dir_util import copy_tree
-import filecmp
-import fileinput
+import hashlib
+import heapq
+import itertools
+import mmap
 import os
+import errno
+import fnmatch
 from pathlib import Path
-import random
+import re
+import shlex
 import shutil
+import stat
+import struct
 import sys
+import time as time_module
 from time import gmtime, strftime
-
-import matplotlib.pyplot as plt
-import networkx as nx
-
-
-LOG_PATH = Path.home() / ".wit" / "log.txt"
-WIT_PATH = Path.home() / ".wit"
-STAGING_AREA_PATH = Path.home() / ".wit" / "staging_area"
-IMAGES_PATH = Path.home() / ".wit" / "images"
-REFERENCES_PATH = Path.home() / ".wit" / "references.txt"
-ACTIVATED_PATH = Path.home() / ".wit" / "activated.txt" 
+import zlib
+
+
+WIT_PATH = Path(os.environ.get("WIT_DIR") or Path.home() / ".wit").absolute()  # the repository in use, see use_repository
+LOG_PATH = WIT_PATH / "log.txt"
+STAGING_AREA_PATH = WIT_PATH / "staging_area"
+IMAGES_PATH = WIT_PATH / "images"
+REFERENCES_PATH = WIT_PATH / "references.txt"
+REFERENCES_LOCK_PATH = WIT_PATH / "references.txt.lock"
+ACTIVATED_PATH = WIT_PATH / "activated.txt"
+OBJECTS_PATH = WIT_PATH / "objects"
+INDEX_PATH = WIT_PATH / "index.txt"
+COMMIT_GRAPH_PATH = WIT_PATH / "commit_graph.txt"
+CONFIG_PATH = WIT_PATH / "config.txt"
+PACKS_PATH = WIT_PATH / "objects" / "pack"
+MERGE_HEAD_PATH = WIT_PATH / "merge_head.txt"
+DAEMON_SOCKET_PATH = WIT_PATH / "daemon.sock"
+SPARSE_PATH = WIT_PATH / "sparse.txt"
+SHALLOW_PATH = WIT_PATH / "shallow.txt"
+FSCK_PATH = WIT_PATH / "fsck.txt"
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_MMAP_THRESHOLD = 16 * 1024 * 1024
+ADD_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+SNAPSHOT_BACKENDS = ("auto", "reflink", "hardlink", "copy")
+FICLONE = 0x40049409  # linux ioctl: share the data blocks of a file (btrfs, xfs, ...)
+PACK_SIGNATURE = b"WITPACK1"
+PACK_INDEX_SIGNATURE = b"WITIDX01"
+PACK_INDEX_RECORD = struct.Struct(">20sQI")  # object id, offset in pack, entry length
+PACK_FULL = 0
+PACK_DELTA = 1
+PACK_STREAM_ENTRY = struct.Struct(">20sBI")  # object id, type, payload length; a delta's base id precedes the payload
+DELTA_BLOCK_SIZE = 32
+DELTA_MAX_SIZE = 16 * 1024 * 1024
+DELTA_MAX_DEPTH = 50
+LOCK_TIMEOUT = 30
+LOG_PAGE_SIZE = 1000
+LOG_BUFFER_LINES = 1000
+DAEMON_TIMEOUT = 60
+INOTIFY_MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200  # modify, attrib, close_write, moved_from/to, create, delete
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+FSCK_CHUNK_SIZE = 256  # objects verified per worker task
+LOCK_STALE_AGE = 120  # seconds after which a lock is considered left by a killed process
+
+
+_log_buffer = []
 
 
 def log(message: str) -> None:
     time = datetime.datetime.now()
-    log_to_add = f"{time} : {message}\n"
+    _log_buffer.append(f"{time} : {message}\n")
+    if len(_log_buffer) >= LOG_BUFFER_LINES:
+        flush_log()
+
+
+def flush_log() -> None:
+    """Write the buffered log lines with one open; called when the buffer fills and at exit.
+    Outside a repository there is no log file, the lines go to stderr."""
+    if not _log_buffer:
+        return
     try:
-        if not LOG_PATH.exists():
-            with open(LOG_PATH, "w+") as log_file:
-                log_file.write(log_to_add)
-        else:
+        if WIT_PATH.is_dir():
             with open(LOG_PATH, "a") as log_file:
-                log_file.write(log_to_add)
-    except FileNotFoundError:
-        raise
+                log_file.write("".join(_log_buffer))
+        else:
+            sys.stderr.write("".join(_log_buffer))
+    finally:
+        _log_buffer.clear()
+
+
+atexit.register(flush_log)
+_trace = None  # spans of this process while tracing, see start_trace
+
+
+def start_trace(output_path: str = None) -> None:
+    """Record trace_span timings; at exit print a summary to stderr and, with output_path, write a
+    Chrome trace (*.json, open in chrome://tracing or Perfetto) or cProfile stats (any other name)."""
+    global _trace
+    _trace = {"spans": [], "start": time_module.perf_counter(), "output_path": output_path, "profiler": None}
+    if output_path and not output_path.endswith(".json"):
+        import cProfile
+        _trace["profiler"] = cProfile.Profile()
+        _trace["profiler"].enable()
+    atexit.register(finish_trace)
+
+
+@contextmanager
+def trace_span(name: str):
+    """Time a phase of a command; the yielded dict takes counters, ex. span["files"] += 1."""
+    counters = {}
+    if _trace is None:
+        yield counters
+        return
+    start_time = time_module.perf_counter()
+    try:
+        yield counters
+    finally:
+        _trace["spans"].append((name, start_time, time_module.perf_counter() - start_time, counters))
+
+
+def finish_trace() -> None:
+    if _trace["profiler"] is not None:
+        _trace["profiler"].disable()
+        _trace["profiler"].dump_stats(_trace["output_path"])
+    elif _trace["output_path"]:
+        import json
+        events = []
+        for name, start_time, duration, counters in _trace["spans"]:
+            start_us = (start_time - _trace["start"]) * 1e6
+            events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": 0, "ts": start_us, "dur": duration * 1e6, "args": counters})
+        with open(_trace["output_path"], "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+    totals = {}
+    for name, _start_time, duration, counters in _trace["spans"]:
+        total = totals.setdefault(name, {"calls": 0, "ms": 0.0})
+        total["calls"] += 1
+        total["ms"] += duration * 1000
+        for counter, value in counters.items():
+            total[counter] = total.get(counter, 0) + value
+    print(f"wit trace - {(time_module.perf_counter() - _trace['start']) * 1000:.1f} ms total", file=sys.stderr)
+    for name, total in totals.items():
+        counters = " ".join(f"{counter}={value}" for counter, value in total.items() if counter not in ("calls", "ms"))
+        print(f"  {name:<20} {total['ms']:9.1f} ms  x{total['calls']:<4} {counters}", file=sys.stderr)
 
 
 def init() -> None:
+    use_repository(Path(os.environ.get("WIT_DIR") or Path.cwd() / ".wit").absolute())
+    _wit_dirs.clear()
     WIT_PATH.mkdir()
     STAGING_AREA_PATH.mkdir()
     IMAGES_PATH.mkdir()
+    OBJECTS_PATH.mkdir()
     try:
         with open(ACTIVATED_PATH, "w+") as activated_file:
                 activated_file.write("master")
     except Exception as err:
         log(err)
     else:
-        log("Success - .wit directory created with images and staging_area sub-directories; activated.txt file created")
+        log("Success - .wit directory created with images, objects and staging_area sub-directories; activated.txt file created")
+
+
+_wit_dirs = {}
+
+
+def find_wit_dir(path: Path):
+    """The .wit directory of the repository path is in: WIT_DIR when it is set, otherwise the
+    nearest of path and its ancestors holding one. One stat per directory, and every directory
+    on the way is memoized, so a process looks each of them up once."""
+    if os.environ.get("WIT_DIR"):
+        return Path(os.environ["WIT_DIR"]).absolute()
+    visited_directories = []
+    wit_dir = None
+    for directory in itertools.chain([path], path.parents):
+        directory_key = str(directory)
+        if directory_key in _wit_dirs:
+            wit_dir = _wit_dirs[directory_key]
+            break
+        visited_directories.append(directory_key)
+        try:
+            if stat.S_ISDIR(os.stat(os.path.join(directory_key, ".wit")).st_mode):
+                wit_dir = directory / ".wit"
+                break
+        except OSError:
+            continue
+    for directory_key in visited_directories:
+        _wit_dirs[directory_key] = wit_dir
+    return wit_dir
+
+
+def use_repository(wit_path: Path) -> None:
+    """Point the module paths at another repository; its working tree is the parent of wit_path."""
+    global WIT_PATH, LOG_PATH, STAGING_AREA_PATH, IMAGES_PATH, REFERENCES_PATH, REFERENCES_LOCK_PATH, ACTIVATED_PATH, OBJECTS_PATH
+    global INDEX_PATH, COMMIT_GRAPH_PATH, CONFIG_PATH, PACKS_PATH, MERGE_HEAD_PATH, DAEMON_SOCKET_PATH, SPARSE_PATH, SHALLOW_PATH, FSCK_PATH
+    if wit_path == WIT_PATH:
+        return
+    try:
+        flush_log()  # the lines so far belong to the previous repository
+    except OSError:
+        pass
+    WIT_PATH = wit_path
+    LOG_PATH = wit_path / "log.txt"
+    STAGING_AREA_PATH = wit_path / "staging_area"
+    IMAGES_PATH = wit_path / "images"
+    REFERENCES_PATH = wit_path / "references.txt"
+    REFERENCES_LOCK_PATH = wit_path / "references.txt.lock"
+    ACTIVATED_PATH = wit_path / "activated.txt"
+    OBJECTS_PATH = wit_path / "objects"
+    INDEX_PATH = wit_path / "index.txt"
+    COMMIT_GRAPH_PATH = wit_path / "commit_graph.txt"
+    CONFIG_PATH = wit_path / "config.txt"
+    PACKS_PATH = wit_path / "objects" / "pack"
+    MERGE_HEAD_PATH = wit_path / "merge_head.txt"
+    DAEMON_SOCKET_PATH = wit_path / "daemon.sock"
+    SPARSE_PATH = wit_path / "sparse.txt"
+    SHALLOW_PATH = wit_path / "shallow.txt"
+    FSCK_PATH = wit_path / "fsck.txt"
+    reset_process_caches()
+
+
+def get_working_root() -> Path:
+    return WIT_PATH.parent
+
+
+def get_working_relative_path(path: Path) -> str:
+    """path from the working root as the index keeps it, "" for the working root itself."""
+    relative_path = path.relative_to(get_working_root()).as_posix()
+    return "" if relative_path == "." else relative_path
 
 
 def is_wit_dir_in_path(path: Path) -> bool:
-    parents = list(path.parents)
-    for parent in parents:
-        if WIT_PATH in list(parent.iterdir()):
-            return True 
-    return False
+    return find_wit_dir(path) == WIT_PATH and WIT_PATH.is_dir()
 
 
 def add(path: str) -> None:
+    response = daemon_request({"command": "add", "path": str(Path(path).absolute())}) if not _session else None  # a session has its own index
+    if response is not None:
+        print(response["output"], end="")
+        return
+    add_path(path)
+
+
+def add_path(path: str) -> None:
     new_path = Path(path).absolute()
-    if new_path.is_dir() or new_path.is_file():
-        if new_path.exists():
-            if is_wit_dir_in_path(new_path):
-                parents = list(new_path.parents)
-                start_creation = False
-                in_dir = STAGING_AREA_PATH
-                for parent in parents[-1::-1]:
-                    if start_creation:
-                        in_dir = in_dir / parent.name
-                        if not in_dir.exists():
-                            in_dir.mkdir()
-                    if WIT_PATH in list(parent.iterdir()):
-                        start_creation = True
+    if new_path.is_dir() or new_path.is_file() or not new_path.exists():
+        if new_path.exists() or is_tracked_path(new_path):  # a deleted file or directory stages its removal
+            if is_wit_dir_in_path(new_path) and get_working_root() in (new_path, *new_path.parents):
+                staging_path = STAGING_AREA_PATH / new_path.relative_to(get_working_root())
                 try:
-                    if new_path.is_file():
-                        file_name = in_dir / new_path.name
-                        shutil.copyfile(path, str(file_name))
-                    else:
-                        directory_name = in_dir / new_path.name
-                        copy_tree(path, str(directory_name))
-                    
+                    stage_files(new_path, staging_path)
                 except Exception as err:
                     log(f"Error - {err}")
                 
@@ -90,28 +259,150 @@ def add(path: str) -> None:
         log(f"Error - invalid path -> {path}")
 
 
-def get_commit_id() -> str:
-    characthers = "1234567890abcdef"
-    length = 40
-    commit_id = ''.join(random.choice(characthers) for _ in range(length))
-    return commit_id
+def is_tracked_path(path: Path) -> bool:
+    """Whether path, a file or a directory of the working tree, has files in the index."""
+    if get_working_root() not in (path, *path.parents) or not is_wit_dir_in_path(path):
+        return False
+    relative_path = get_working_relative_path(path)
+    prefix = relative_path + "/" if relative_path else ""
+    return any(tracked_path == relative_path or tracked_path.startswith(prefix) for tracked_path in load_index())
+
+
+def remove_missing_files(index: dict, relative_path: str, added_paths: set) -> int:
+    """Drop from the index and the staging area the tracked files under relative_path ("" for
+    all) that were deleted from the original path; returns how many. Files outside the sparse
+    checkout are not in the original path on purpose and are kept."""
+    sparse_patterns = load_sparse_patterns()
+    prefix = relative_path + "/" if relative_path else ""
+    removed_files = []
+    for tracked_path in index:
+        if tracked_path != relative_path and not tracked_path.startswith(prefix) or tracked_path in added_paths:
+            continue
+        if sparse_patterns is not None and not is_sparse_path(tracked_path, sparse_patterns):
+            continue
+        if not get_working_path(tracked_path).is_file():
+            removed_files.append(tracked_path)
+    for tracked_path in removed_files:
+        del index[tracked_path]
+        remove_file(STAGING_AREA_PATH / tracked_path, STAGING_AREA_PATH)
+    return len(removed_files)
+
+
+def remove_replaced_files(index: dict, relative_paths: list) -> int:
+    """Unstage what the files about to be staged replace: a staged file where one of their
+    directories now is, or a staged directory where a file now is. Returns how many files."""
+    removed_files = set()
+    for relative_path in relative_paths:
+        directory = relative_path.rpartition("/")[0]
+        while directory:  # a file replaced by a directory
+            if directory in index:
+                removed_files.add(directory)
+            directory = directory.rpartition("/")[0]
+        if relative_path not in index and (STAGING_AREA_PATH / relative_path).is_dir():  # a directory replaced by a file
+            prefix = relative_path + "/"
+            removed_files.update(tracked_path for tracked_path in index if tracked_path.startswith(prefix))
+    for tracked_path in removed_files:
+        del index[tracked_path]
+        remove_file(STAGING_AREA_PATH / tracked_path, STAGING_AREA_PATH)
+    for relative_path in relative_paths:
+        if (STAGING_AREA_PATH / relative_path).is_dir():  # left with no tracked file in it
+            shutil.rmtree(str(STAGING_AREA_PATH / relative_path))
+    return len(removed_files)
+
+
+def copy_and_hash_file(source_path: Path, dest_path: Path) -> str:
+    temp_path = dest_path.with_name(f".{dest_path.name}.wit_{os.getpid()}.tmp")
+    try:
+        if get_snapshot_backend() in ("auto", "reflink") and reflink_file(source_path, temp_path):
+            blob_id = hash_file(source_path)
+            os.replace(str(temp_path), str(dest_path))
+            return blob_id
+        sha = hashlib.sha1()
+        with open(str(source_path), 'rb') as source_file, open(str(temp_path), 'wb') as dest_file:
+            for chunk in iter(lambda: source_file.read(HASH_CHUNK_SIZE), b""):
+                sha.update(chunk)
+                dest_file.write(chunk)
+        shutil.copymode(str(source_path), str(temp_path))
+        os.replace(str(temp_path), str(dest_path))
+    except BaseException:
+        if temp_path.exists():
+            temp_path.unlink()
+        raise
+    _hash_cache[get_hash_cache_key(source_path.stat())] = sha.hexdigest()
+    return sha.hexdigest()
+
+
+def stage_file(working_path: Path, staged_path: Path, entry) -> tuple:
+    """Bring one file of the staging area up to date; returns (blob id, stat, copied)."""
+    stat_result = working_path.stat()
+    staged = entry is not None and staged_path.exists()
+    if staged and is_stat_unchanged(entry, stat_result):
+        return entry[0], stat_result, False
+    if staged and get_hash_cache_key(stat_result) in _hash_cache and hash_file(working_path) == entry[0]:
+        return entry[0], stat_result, False
+    # A changed stat almost always means changed content: hash while copying, one read per file
+    staged_path.parent.mkdir(parents=True, exist_ok=True)
+    blob_id = copy_and_hash_file(working_path, staged_path)
+    return blob_id, stat_result, not staged or blob_id != entry[0]
+
+
+def stage_files(new_path: Path, staging_path: Path) -> None:
+    """Copy a file or a directory to the staging area with a thread pool, skipping files whose
+    staged copy already has the same content."""
+    start_time = time_module.perf_counter()
+    index = load_index()
+    relative_root = "" if staging_path == STAGING_AREA_PATH else staging_path.relative_to(STAGING_AREA_PATH).as_posix()
+    with trace_span("walk") as span:
+        if new_path.is_file():
+            added_files = [(new_path, staging_path)]
+        elif new_path.is_dir():
+            walked_files = walk_files(new_path, relative_root, load_ignore_patterns(), tracked_paths=index)
+            added_files = [(Path(entry.path), STAGING_AREA_PATH / relative_path) for relative_path, entry in walked_files]
+        else:
+            added_files = []  # deleted, only its removal is staged
+        span["files"] = len(added_files)
+    relative_paths = [staged_path.relative_to(STAGING_AREA_PATH).as_posix() for _working_path, staged_path in added_files]
+    replaced_files = remove_replaced_files(index, relative_paths)
+    with trace_span("hash and copy") as span:
+        from concurrent.futures import ThreadPoolExecutor  # imports logging, keep it off the startup path
+        working_paths = [working_path for working_path, _staged_path in added_files]
+        staged_paths = [staged_path for _working_path, staged_path in added_files]
+        staged_entries = [index.get(relative_path) for relative_path in relative_paths]
+        with ThreadPoolExecutor(max_workers=ADD_WORKERS) as executor:
+            results = list(executor.map(stage_file, working_paths, staged_paths, staged_entries))
+        copied_files = 0
+        copied_bytes = 0
+        for relative_path, (blob_id, stat_result, copied) in zip(relative_paths, results):
+            set_index_entry(index, relative_path, blob_id, stat_result)
+            if copied:
+                copied_files += 1
+                copied_bytes += stat_result.st_size
+        span["files"] = copied_files
+        span["bytes"] = copied_bytes
+    removed_files = replaced_files + remove_missing_files(index, relative_root, set(relative_paths))
+    save_index(index)
+    elapsed = max(time_module.perf_counter() - start_time, 1e-9)
+    rates = f"{len(added_files) / elapsed:.0f} files/s, {copied_bytes / elapsed / 1024 / 1024:.1f} MB/s"
+    counts = f"{copied_files} copied, {copied_bytes} bytes, {removed_files} removed"
+    message = f"Added {len(added_files)} files ({counts}) in {elapsed:.2f}s - {rates}"
+    print(message)
+    log(f"Success - {message}")
+
+
+def get_commit_id(metadata: str) -> str:
+    """The sha1 of the commit metadata (parents, date, message and tree), so a commit id is
+    derived from its content: the same commit always gets the same id and ids never collide."""
+    return hashlib.sha1(metadata.encode()).hexdigest()
 
 
 def get_parent():
     if not REFERENCES_PATH.exists():
         return None
-    else:
-        try:
-            with open(str(REFERENCES_PATH), 'r') as file:
-                file_txt = file.readlines()
-        except PermissionError as err:
-            log(err)
-        else:
-            parent_head = file_txt[0][file_txt[0].find("=") + 1:-1]
-            return parent_head
+    return get_reference("HEAD")
 
 
-def create_metadata_file(commit_id: str, message: str, images_path: Path, optional_commit_after_merge_branch_id) -> None:
+def create_metadata_file(message: str, images_path: Path, optional_commit_after_merge_branch_id, tree_id: str) -> tuple:
+    """Write images/<commit id>.txt; returns (commit id, parent ids), ("", []) when it can't be written."""
     text_to_add = ""
     parent = get_parent()
     if not optional_commit_after_merge_branch_id:
@@ -122,23 +413,895 @@ def create_metadata_file(commit_id: str, message: str, images_path: Path, option
     time = datetime.datetime.now().strftime(f"%a %b %d %X %Y{time_zone}")
     row2 = f"date={time}\n"
     row3 = f"message={message}\n"
+    row4 = f"tree={tree_id}\n"
     text_to_add += row1
     text_to_add += row2
     text_to_add += row3
+    text_to_add += row4
+    commit_id = get_commit_id(text_to_add)
     file_name = commit_id + ".txt"
     file_path = images_path / file_name
+    temp_path = images_path / f"{commit_id}_{os.getpid()}.tmp"
     try:
-        with open(file_path, 'w+') as file_handler:
+        with open(temp_path, 'w+') as file_handler:
             file_handler.write(text_to_add)
-    except PermissionError as err:
+        os.replace(str(temp_path), str(file_path))  # atomic, an interrupted commit leaves no half written image
+    except OSError as err:
+        log(f"Error - commit metadata not written -> {err}")
+        if temp_path.exists():
+            temp_path.unlink()
+        return "", []
+    return commit_id, [parent_id for parent_id in row1[7:-1].split(",") if parent_id not in ("None", "")]
+
+
+_config = {}
+
+
+def get_config(key: str, default: str = "") -> str:
+    if not _config and CONFIG_PATH.exists():
+        try:
+            with open(str(CONFIG_PATH), 'r') as config_file:
+                for line in config_file:
+                    if "=" in line:
+                        config_key, value = line.rstrip("\n").split("=", 1)
+                        _config[config_key] = value
+        except Exception as err:
+            log(err)
+    return _config.get(key, default)
+
+
+def set_config(key: str, value: str) -> None:
+    get_config(key)
+    _config[key] = value
+    try:
+        with open(str(CONFIG_PATH), 'w') as config_file:
+            config_file.writelines(f"{config_key}={config_value}\n" for config_key, config_value in _config.items())
+    except Exception as err:
+        log(err)
+
+
+def config(key: str, value: str) -> None:
+    cwd_path = Path.cwd().absolute()
+    if is_wit_dir_in_path(cwd_path):
+        if key == "snapshot" and value not in SNAPSHOT_BACKENDS:
+            log(f"Error - invalid snapshot backend -> {value}; choose one of {', '.join(SNAPSHOT_BACKENDS)}")
+        else:
+            set_config(key, value)
+    else:
+        log(f"Error - wit directory not found in -> {cwd_path}")
+
+
+def get_snapshot_backend() -> str:
+    backend = get_config("snapshot", "auto")
+    return backend if backend in SNAPSHOT_BACKENDS else "auto"
+
+
+_unsupported_snapshot_methods = set()
+
+
+def reflink_file(source_path: Path, dest_path: Path) -> bool:
+    """Copy-on-write clone of source_path; False when the filesystem can't do it."""
+    if "reflink" in _unsupported_snapshot_methods:
+        return False
+    try:
+        import fcntl
+        with open(str(source_path), 'rb') as source_file, open(str(dest_path), 'wb') as dest_file:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+    except (ImportError, OSError):
+        _unsupported_snapshot_methods.add("reflink")
+        if dest_path.exists():
+            dest_path.unlink()
+        return False
+    return True
+
+
+def link_file(source_path: Path, dest_path: Path) -> bool:
+    if "hardlink" in _unsupported_snapshot_methods:
+        return False
+    try:
+        os.link(str(source_path), str(dest_path))
+    except OSError:
+        _unsupported_snapshot_methods.add("hardlink")
+        return False
+    return True
+
+
+def snapshot_file(source_path: Path, dest_path: Path, allow_hardlink: bool = False) -> None:
+    """Create dest_path with the content of source_path using the configured snapshot backend.
+
+    Hard links are only used between the objects store and the staging area, whose files are
+    always replaced and never written in place; the original path gets reflinks or copies.
+    """
+    backend = get_snapshot_backend()
+    if backend in ("auto", "reflink") and reflink_file(source_path, dest_path):
+        return
+    if allow_hardlink and backend in ("auto", "hardlink") and link_file(source_path, dest_path):
+        return
+    shutil.copyfile(str(source_path), str(dest_path))
+
+
+def get_object_path(object_id: str) -> Path:
+    return OBJECTS_PATH / object_id[:2] / object_id[2:]
+
+
+_hash_cache = {}
+
+
+def get_hash_cache_key(stat_result) -> tuple:
+    return stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
+
+def hash_file(path: Path) -> str:
+    """sha1 of a file, read in chunks (mmap for large files) so it is never fully in memory.
+
+    Results are cached per process by (device, inode, size, mtime), so a file that several
+    steps of one command look at is read only once.
+    """
+    stat_result = os.stat(str(path))
+    cache_key = get_hash_cache_key(stat_result)
+    if cache_key in _hash_cache:
+        return _hash_cache[cache_key]
+    sha = hashlib.sha1()
+    with trace_span("hash") as span, open(str(path), 'rb') as file:
+        if stat_result.st_size >= HASH_MMAP_THRESHOLD:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                if hasattr(mapped_file, "madvise"):
+                    mapped_file.madvise(mmap.MADV_SEQUENTIAL)
+                for offset in range(0, stat_result.st_size, HASH_CHUNK_SIZE):
+                    sha.update(mapped_file[offset:offset + HASH_CHUNK_SIZE])
+        else:
+            for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+                sha.update(chunk)
+        span["files"] = 1
+        span["bytes"] = stat_result.st_size
+    _hash_cache[cache_key] = sha.hexdigest()
+    return _hash_cache[cache_key]
+
+
+def store_object_file(temp_path: Path, object_id: str) -> None:
+    object_path = get_object_path(object_id)
+    if object_path.exists():
+        temp_path.unlink()
+    else:
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(str(temp_path), str(object_path))  # atomic, readers never see half written objects
+
+
+def write_blob(path: Path, allow_hardlink: bool = False, blob_id: str = None) -> str:
+    if blob_id is None:
+        blob_id = hash_file(path)
+    if not has_object(blob_id):
+        OBJECTS_PATH.mkdir(exist_ok=True)
+        temp_path = OBJECTS_PATH / f"tmp_{os.getpid()}_{blob_id}"
+        snapshot_file(path, temp_path, allow_hardlink)
+        store_object_file(temp_path, blob_id)
+    return blob_id
+
+
+def write_object(data: bytes) -> str:
+    object_id = hashlib.sha1(data).hexdigest()
+    if not has_object(object_id):
+        OBJECTS_PATH.mkdir(exist_ok=True)
+        temp_path = OBJECTS_PATH / f"tmp_{os.getpid()}_{object_id}"
+        with open(str(temp_path), 'wb') as temp_file:
+            temp_file.write(data)
+        store_object_file(temp_path, object_id)
+    return object_id
+
+
+def has_object(object_id: str) -> bool:
+    return get_object_path(object_id).exists() or find_packed_object(object_id) is not None
+
+
+def read_object(object_id: str) -> bytes:
+    object_path = get_object_path(object_id)
+    if not object_path.exists():
+        if find_packed_object(object_id) is None:
+            fetch_missing_objects(object_ids=[object_id])  # shallow / partial clone
+        return read_packed_object(object_id)
+    with open(str(object_path), 'rb') as object_file:
+        return object_file.read()
+
+
+def write_tree(directory: Path, allow_hardlink: bool = False, known_blob_ids: dict = None, prefix: str = "") -> str:
+    """Store every file under directory as a blob and return the id of the tree object describing it.
+
+    Tree objects are text, one "<type> <id> <name>" line per entry, so unchanged files and
+    sub directories keep the same id and are stored only once for all the commits.
+    known_blob_ids ({relative path: blob id}, ex. from the index) saves hashing those files again.
+    """
+    known_blob_ids = known_blob_ids or {}
+    entries = []
+    for entry in sorted(os.scandir(str(directory)), key=lambda dir_entry: dir_entry.name):
+        if entry.is_dir(follow_symlinks=False):
+            entries.append(("tree", write_tree(Path(entry.path), allow_hardlink, known_blob_ids, prefix + entry.name + '/'), entry.name))
+        elif entry.is_file():
+            entries.append(("blob", write_blob(Path(entry.path), allow_hardlink, known_blob_ids.get(prefix + entry.name)), entry.name))
+    return write_object(format_tree(entries))
+
+
+def get_index_trees(index: dict) -> tuple:
+    """Build the tree objects of the index in memory, bottom up from the staged blob ids,
+    without reading the staging area. Returns (root tree id, {tree id: [(type, id, name)]});
+    the ids are the ones write_tree gives, so a directory staged unchanged has the tree id
+    it has in HEAD and can be recognized without looking inside it."""
+    directories = {"": {}}
+    for relative_path, entry in index.items():
+        directory, _separator, name = relative_path.rpartition("/")
+        directories.setdefault(directory, {})[name] = ["blob", entry[0]]
+        while directory:  # register the directories up to the first known one
+            parent, _separator, name = directory.rpartition("/")
+            if name in directories.setdefault(parent, {}):
+                break
+            directories[parent][name] = ["tree", ""]
+            directory = parent
+    trees = {}
+    tree_ids = {}
+    for directory in sorted(directories, key=lambda path: -path.count("/") if path else 1):  # children first, the root last
+        entries = directories[directory]
+        for name, entry in entries.items():
+            if entry[0] == "tree":
+                entry[1] = tree_ids[f"{directory}/{name}" if directory else name]
+        tree_entries = [(object_type, object_id, name) for name, (object_type, object_id) in sorted(entries.items())]
+        tree_id = hashlib.sha1(format_tree(tree_entries)).hexdigest()
+        trees[tree_id] = tree_entries
+        tree_ids[directory] = tree_id
+    return tree_ids[""], trees
+
+
+def format_tree(entries: list) -> bytes:
+    return "".join(f"{object_type} {object_id} {name}\n" for object_type, object_id, name in entries).encode()
+
+
+def write_index_tree(index: dict, span: dict = None) -> str:
+    """Store the tree of the index and the staged blobs it needs; returns its id. A tree that
+    is already stored is skipped as a whole, so a commit only touches the directories that
+    changed since any earlier commit."""
+    root_id, trees = get_index_trees(index)
+    new_tree_ids = []
+    written_blobs = 0
+    directories = [(root_id, "")]
+    while directories:
+        tree_id, prefix = directories.pop()
+        if has_object(tree_id):  # trees are stored after everything under them
+            continue
+        new_tree_ids.append(tree_id)
+        for object_type, object_id, name in trees[tree_id]:
+            if object_type == "tree":
+                directories.append((object_id, prefix + name + "/"))
+            elif not has_object(object_id):
+                write_blob(STAGING_AREA_PATH / (prefix + name), allow_hardlink=True, blob_id=object_id)
+                written_blobs += 1
+    for tree_id in reversed(new_tree_ids):  # children before their parents
+        write_object(format_tree(trees[tree_id]))
+    if span is not None:
+        span["files"] = written_blobs
+        span["trees"] = len(new_tree_ids)
+    return root_id
+
+
+def read_tree(tree_id: str) -> list:
+    if not has_object(tree_id):
+        fetch_missing_objects(tree_ids=[tree_id])  # with everything under it, in one pack
+    entries = []
+    for line in read_object(tree_id).decode().splitlines():
+        object_type, object_id, name = line.split(" ", 2)
+        entries.append((object_type, object_id, name))
+    return entries
+
+
+def get_tree_files(tree_id: str, prefix: str = "") -> dict:
+    """Flatten a tree object to {relative file path: blob id}."""
+    tree_files = {}
+    for object_type, object_id, name in read_tree(tree_id):
+        relative_path = prefix + name
+        if object_type == "tree":
+            tree_files.update(get_tree_files(object_id, relative_path + "/"))
+        else:
+            tree_files[relative_path] = object_id
+    return tree_files
+
+
+def restore_file(blob_id: str, dest_path: Path, allow_hardlink: bool = False) -> None:
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = dest_path.with_name(f".{dest_path.name}.wit_{os.getpid()}.tmp")
+    object_path = get_object_path(blob_id)
+    if object_path.exists():
+        snapshot_file(object_path, temp_path, allow_hardlink)
+    else:
+        with open(str(temp_path), 'wb') as temp_file:
+            temp_file.write(read_object(blob_id))
+    os.replace(str(temp_path), str(dest_path))
+
+
+def remove_file(path: Path, stop_dir: Path) -> None:
+    """Delete path and every parent directory it leaves empty, up to stop_dir."""
+    if path.exists():
+        path.unlink()
+    parent = path.parent
+    while parent != stop_dir and parent.exists() and not any(parent.iterdir()):
+        parent.rmdir()
+        parent = parent.parent
+
+
+def get_tree_changes(old_tree_id: str, new_tree_id: str) -> tuple:
+    """Return ({path: blob id} to write, [paths] to delete) turning one tree into the other,
+    reading only the sub trees that differ."""
+    changed_files = {}
+    deleted_files = []
+    for relative_path, _old_id, new_id in iter_tree_changes(old_tree_id, new_tree_id):
+        if new_id is None:
+            deleted_files.append(relative_path)
+        else:
+            changed_files[relative_path] = new_id
+    return changed_files, deleted_files
+
+
+def iter_tree_changes(old_tree_id: str, new_tree_id: str, prefix: str = "", path_patterns: tuple = None, unstored_trees: dict = None):
+    """Yield (relative path, old blob id or None, new blob id or None) for the files that differ
+    between two trees ("" for none), sorted by path. Sub trees with the same id are skipped
+    without being read, and with path_patterns only matching paths are compared.
+    unstored_trees ({tree id: entries}, ex. from get_index_trees) are used instead of the store."""
+    if old_tree_id == new_tree_id:
+        return
+    unstored_trees = unstored_trees or {}
+    old_entries = {name: (object_type, object_id) for object_type, object_id, name in (unstored_trees[old_tree_id] if old_tree_id in unstored_trees else read_tree(old_tree_id))} if old_tree_id else {}
+    new_entries = {name: (object_type, object_id) for object_type, object_id, name in (unstored_trees[new_tree_id] if new_tree_id in unstored_trees else read_tree(new_tree_id))} if new_tree_id else {}
+    for name in sorted(old_entries.keys() | new_entries.keys()):
+        relative_path = prefix + name
+        old_type, old_id = old_entries.get(name, (None, None))
+        new_type, new_id = new_entries.get(name, (None, None))
+        if old_id == new_id:
+            continue
+        if "tree" in (old_type, new_type) and path_patterns is not None and not may_contain_sparse_paths(relative_path, path_patterns) and not is_sparse_path(relative_path, path_patterns):
+            continue
+        if old_type == "tree" or new_type == "tree":
+            changes = iter_tree_changes(old_id if old_type == "tree" else "", new_id if new_type == "tree" else "", relative_path + "/", path_patterns, unstored_trees)
+            if old_type == new_type:
+                yield from changes
+                continue
+            blob_change = (relative_path, old_id if old_type == "blob" else None, new_id if new_type == "blob" else None)
+            if "blob" in (old_type, new_type) and (path_patterns is None or is_sparse_path(relative_path, path_patterns)):
+                yield blob_change  # a file replaced by a directory or the other way, before its content
+            yield from changes
+        elif path_patterns is None or is_sparse_path(relative_path, path_patterns):
+            yield relative_path, old_id, new_id
+
+
+def apply_tree_changes(changed_files: dict, deleted_files: list, dest_dir: Path, allow_hardlink: bool = False) -> None:
+    for relative_path in deleted_files:
+        remove_file(dest_dir / relative_path, dest_dir)
+    for relative_path, blob_id in changed_files.items():
+        restore_file(blob_id, dest_dir / relative_path, allow_hardlink)
+
+
+def get_commit_tree_id(commit_id: str) -> str:
+    file_path = IMAGES_PATH / (commit_id + ".txt")
+    try:
+        with open(str(file_path), 'r') as file:
+            for line in file.readlines():
+                if line.startswith("tree="):
+                    return line[5:].strip()
+    except Exception as err:
         log(err)
+        return ""
+    return migrate_image(commit_id)  # commit made before the object store existed
 
 
-def copy_content(source_dir: Path, dest_dir: Path) -> None:
+def migrate_image(commit_id: str) -> str:
+    image_path = IMAGES_PATH / commit_id
+    if not image_path.is_dir():
+        log(f"Error - no tree found for commit -> {commit_id}")
+        return ""
+    tree_id = write_tree(image_path, allow_hardlink=True)  # the image directory is removed right after
     try:
-        copy_tree(str(source_dir), str(dest_dir))
+        with open(str(IMAGES_PATH / (commit_id + ".txt")), 'a') as file:
+            file.write(f"tree={tree_id}\n")
     except Exception as err:
         log(err)
+        return tree_id
+    shutil.rmtree(str(image_path))
+    log(f"Success - images/{commit_id} migrated to the objects store")
+    return tree_id
+
+
+def migrate() -> None:
+    cwd_path = Path.cwd().absolute()
+    if is_wit_dir_in_path(cwd_path):
+        for image_path in IMAGES_PATH.iterdir():
+            if image_path.is_dir():
+                migrate_image(image_path.name)
+    else:
+        log(f"Error - wit directory not found in -> {cwd_path}")
+
+
+_packs = []
+
+
+def load_packs() -> list:
+    """[(pack path, index mmap, objects count)] of every pack, mapped once per process."""
+    if not _packs and PACKS_PATH.exists():
+        for index_path in sorted(PACKS_PATH.glob("*.idx")):
+            try:
+                with open(str(index_path), 'rb') as index_file:
+                    index_map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except Exception as err:
+                log(err)
+                continue
+            if index_map[:8] != PACK_INDEX_SIGNATURE:
+                log(f"Error - invalid pack index -> {index_path}")
+                continue
+            count = struct.unpack(">I", index_map[8:12])[0]
+            _packs.append((index_path.with_suffix(".pack"), index_map, count))
+    return _packs
+
+
+def find_packed_object(object_id: str):
+    """Binary search of the sorted pack indexes; returns (pack path, offset, length) or None."""
+    raw_id = bytes.fromhex(object_id)
+    for pack_path, index_map, count in load_packs():
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            record_offset = 12 + middle * PACK_INDEX_RECORD.size
+            record_id, offset, length = PACK_INDEX_RECORD.unpack_from(index_map, record_offset)
+            if record_id == raw_id:
+                return pack_path, offset, length
+            if record_id < raw_id:
+                low = middle + 1
+            else:
+                high = middle
+    return None
+
+
+def read_packed_object(object_id: str) -> bytes:
+    location = find_packed_object(object_id)
+    if location is None:
+        raise FileNotFoundError(f"object not found -> {object_id}")
+    pack_path, offset, length = location
+    with open(str(pack_path), 'rb') as pack_file:
+        pack_file.seek(offset)
+        entry = pack_file.read(length)
+    if entry[0] == PACK_FULL:
+        return zlib.decompress(entry[1:])
+    base_id = entry[1:21].hex()
+    return apply_delta(read_object(base_id), zlib.decompress(entry[21:]))
+
+
+def create_delta(base: bytes, target: bytes) -> bytes:
+    """Encode target as copy (b"C" offset length) and insert (b"I" length data) instructions
+    over the blocks it shares with base."""
+    blocks = {}
+    for offset in range(0, len(base) - DELTA_BLOCK_SIZE + 1, DELTA_BLOCK_SIZE):
+        blocks.setdefault(base[offset:offset + DELTA_BLOCK_SIZE], offset)
+    instructions = []
+    insert_start = 0
+    position = 0
+    while position <= len(target) - DELTA_BLOCK_SIZE:
+        base_offset = blocks.get(target[position:position + DELTA_BLOCK_SIZE])
+        if base_offset is None:
+            position += 1
+            continue
+        length = DELTA_BLOCK_SIZE
+        while base_offset + length < len(base) and position + length < len(target) and base[base_offset + length] == target[position + length]:
+            length += 1
+        while base_offset > 0 and position > insert_start and base[base_offset - 1] == target[position - 1]:
+            base_offset -= 1
+            position -= 1
+            length += 1
+        if position > insert_start:
+            instructions.append(b"I" + struct.pack(">I", position - insert_start) + target[insert_start:position])
+        instructions.append(b"C" + struct.pack(">II", base_offset, length))
+        position += length
+        insert_start = position
+    if insert_start < len(target):
+        instructions.append(b"I" + struct.pack(">I", len(target) - insert_start) + target[insert_start:])
+    return b"".join(instructions)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    parts = []
+    position = 0
+    while position < len(delta):
+        if delta[position:position + 1] == b"C":
+            offset, length = struct.unpack_from(">II", delta, position + 1)
+            parts.append(base[offset:offset + length])
+            position += 9
+        else:
+            length = struct.unpack_from(">I", delta, position + 1)[0]
+            parts.append(delta[position + 5:position + 5 + length])
+            position += 5 + length
+    return b"".join(parts)
+
+
+def walk_tree_objects(tree_id: str, prefix: str = ""):
+    """Yield (relative path, object type, object id) for a tree and everything under it."""
+    yield prefix, "tree", tree_id
+    for object_type, object_id, name in read_tree(tree_id):
+        if object_type == "tree":
+            yield from walk_tree_objects(object_id, prefix + name + "/")
+        else:
+            yield prefix + name, object_type, object_id
+
+
+def get_objects_to_pack(include_packed: bool) -> tuple:
+    """Objects of all commits except the ones HEAD and the staging area use, which stay loose
+    for fast checkouts and hard links. Returns ([tree ids], {relative path: [blob ids newest first]})."""
+    keep = set(entry[0] for entry in load_index().values())
+    head_tree_id = get_commit_tree_id(get_head_id()) if REFERENCES_PATH.exists() else ""
+    if head_tree_id and has_object(head_tree_id):
+        keep.update(object_id for _path, _type, object_id in walk_tree_objects(head_tree_id))
+    keep = set(object_id for object_id in keep if get_object_path(object_id).exists())  # already packed ones move to the new pack
+    commit_graph = load_commit_graph()
+    seen = set(keep)
+    tree_ids = []
+    blobs_by_path = {}
+    for commit_id in sorted(commit_graph, key=lambda graph_commit_id: -commit_graph[graph_commit_id][0]):
+        tree_id = get_commit_tree_id(commit_id)
+        if not tree_id or tree_id in seen:
+            continue
+        stack = [("", tree_id)]
+        while stack:  # skip sub trees that were already collected from a newer commit
+            prefix, current_tree_id = stack.pop()
+            if current_tree_id in seen or not has_object(current_tree_id):  # not fetched yet in a shallow clone
+                continue
+            seen.add(current_tree_id)
+            tree_ids.append(current_tree_id)
+            for object_type, object_id, name in read_tree(current_tree_id):
+                if object_type == "tree":
+                    stack.append((prefix + name + "/", object_id))
+                elif object_id not in seen and has_object(object_id):
+                    seen.add(object_id)
+                    blobs_by_path.setdefault(prefix + name, []).append(object_id)
+    if not include_packed:
+        tree_ids = [tree_id for tree_id in tree_ids if get_object_path(tree_id).exists()]
+        blobs_by_path = {relative_path: [blob_id for blob_id in blob_ids if get_object_path(blob_id).exists()] for relative_path, blob_ids in blobs_by_path.items()}
+    return tree_ids, blobs_by_path
+
+
+def compress_pack_entries(tree_ids: list, blobs_by_path: dict):
+    """Yield the pack entries (object id, type, base id or None, payload) of tree_ids and
+    blobs_by_path ({relative path: [blob ids newest first]})."""
+    for tree_id in tree_ids:
+        yield tree_id, PACK_FULL, None, zlib.compress(read_object(tree_id), 9)
+    depths = {}
+    for blob_ids in blobs_by_path.values():
+        newer_id, newer_data = None, None
+        for blob_id in blob_ids:  # each version is a delta against the next newer version of the same path
+            data = read_object(blob_id)
+            full_payload = zlib.compress(data, 9)
+            entry = (blob_id, PACK_FULL, None, full_payload)
+            if newer_id is not None and depths[newer_id] < DELTA_MAX_DEPTH and len(data) <= DELTA_MAX_SIZE:
+                delta_payload = zlib.compress(create_delta(newer_data, data), 9)
+                if len(delta_payload) + 20 < len(full_payload):
+                    entry = (blob_id, PACK_DELTA, newer_id, delta_payload)
+            depths[blob_id] = depths[newer_id] + 1 if entry[1] == PACK_DELTA else 0
+            yield entry
+            newer_id, newer_data = blob_id, data
+
+
+def write_pack(entries) -> Path:
+    """entries: iterable of (object id, type, base id or None, payload); writes pack + index atomically."""
+    PACKS_PATH.mkdir(parents=True, exist_ok=True)
+    temp_pack_path = PACKS_PATH / f"tmp_{os.getpid()}.pack"
+    temp_index_path = PACKS_PATH / f"tmp_{os.getpid()}.idx"
+    records = []
+    pack_sha = hashlib.sha1()
+    with open(str(temp_pack_path), 'wb') as pack_file:
+        pack_file.write(PACK_SIGNATURE)
+        offset = len(PACK_SIGNATURE)
+        for object_id, entry_type, base_id, payload in entries:
+            entry = bytes([entry_type]) + (bytes.fromhex(base_id) if base_id else b"") + payload
+            pack_file.write(entry)
+            pack_sha.update(bytes.fromhex(object_id))
+            records.append((bytes.fromhex(object_id), offset, len(entry)))
+            offset += len(entry)
+    records.sort()
+    with open(str(temp_index_path), 'wb') as index_file:
+        index_file.write(PACK_INDEX_SIGNATURE + struct.pack(">I", len(records)))
+        for record in records:
+            index_file.write(PACK_INDEX_RECORD.pack(*record))
+    pack_path = PACKS_PATH / f"pack-{pack_sha.hexdigest()}.pack"
+    os.replace(str(temp_pack_path), str(pack_path))
+    os.replace(str(temp_index_path), str(pack_path.with_suffix(".idx")))  # index last, the pack is visible only when complete
+    return pack_path
+
+
+def pack_objects(include_packed: bool) -> None:
+    with trace_span("pack walk") as span:
+        tree_ids, blobs_by_path = get_objects_to_pack(include_packed)
+        span["objects"] = len(tree_ids) + sum(len(blob_ids) for blob_ids in blobs_by_path.values())
+    with trace_span("pack compress") as span:
+        entries = list(compress_pack_entries(tree_ids, blobs_by_path))
+        span["objects"] = len(entries)
+        span["bytes"] = sum(len(entry[3]) for entry in entries)
+    if not entries:
+        log("Success - nothing to pack")
+        return
+    old_packs = [pack_path for pack_path, _index_map, _count in load_packs()] if include_packed else []
+    pack_path = write_pack(entries)
+    for object_id, _entry_type, _base_id, _payload in entries:
+        if get_object_path(object_id).exists():
+            get_object_path(object_id).unlink()
+    for _pack_path, index_map, _count in _packs:
+        index_map.close()
+    _packs.clear()
+    for old_pack_path in old_packs:
+        if old_pack_path != pack_path:
+            old_pack_path.with_suffix(".idx").unlink()
+            old_pack_path.unlink()
+    log(f"Success - {len(entries)} objects packed into {pack_path.name}")
+
+
+def gc() -> None:
+    cwd_path = Path.cwd().absolute()
+    if is_wit_dir_in_path(cwd_path):
+        pack_objects(include_packed=False)
+    else:
+        log(f"Error - wit directory not found in -> {cwd_path}")
+
+
+def repack() -> None:
+    cwd_path = Path.cwd().absolute()
+    if is_wit_dir_in_path(cwd_path):
+        pack_objects(include_packed=True)
+    else:
+        log(f"Error - wit directory not found in -> {cwd_path}")
+
+
+def verify_objects(wit_path: str, object_ids: list) -> list:
+    """fsck worker: [(object id, problem)] for the objects that are missing or whose content
+    doesn't hash to their id."""
+    use_repository(Path(wit_path))  # a spawned worker starts in the default repository
+    problems = []
+    for object_id in object_ids:
+        try:
+            object_path = get_object_path(object_id)
+            if object_path.exists():
+                actual_id = hash_file(object_path)
+            elif find_packed_object(object_id) is not None:
+                actual_id = hashlib.sha1(read_packed_object(object_id)).hexdigest()
+            else:
+                problems.append((object_id, "missing"))
+                continue
+        except Exception as err:  # unreadable file, broken zlib stream or delta
+            problems.append((object_id, f"unreadable ({err})"))
+            continue
+        if actual_id != object_id:
+            problems.append((object_id, f"content hashes to {actual_id}"))
+    return problems
+
+
+def show_progress(title: str, done: int, total: int) -> None:
+    sys.stderr.write(f"\r{title}: {done * 100 // max(total, 1)}% ({done}/{total})" + ("\n" if done >= total else ""))
+    sys.stderr.flush()
+
+
+def check_commits(shallow_ids: set) -> tuple:
+    """Check the metadata and parent links of every commit; returns ({commit id: tree id},
+    problems, number of commits whose id is not the hash of their metadata, number of commits)."""
+    commit_graph = load_commit_graph()
+    tree_ids = {}
+    problems = []
+    legacy_ids = 0
+    commit_ids = [metadata_path.stem for metadata_path in IMAGES_PATH.glob("*.txt")]
+    for done, commit_id in enumerate(commit_ids, 1):
+        try:
+            metadata_text = (IMAGES_PATH / f"{commit_id}.txt").read_text()
+        except Exception as err:
+            problems.append(f"commit {commit_id}: unreadable ({err})")
+            continue
+        metadata = dict(line.partition("=")[::2] for line in metadata_text.splitlines())
+        missing_keys = [key for key in ("parent", "date", "message") if key not in metadata]
+        if missing_keys:
+            problems.append(f"commit {commit_id}: no {', '.join(missing_keys)} in metadata")
+        if get_commit_id(metadata_text) != commit_id:  # every commit made before ids were content hashes
+            legacy_ids += 1
+        parents = [parent for parent in metadata.get("parent", "None").split(",") if parent not in ("None", "")]
+        missing_parents = [parent for parent in parents if not (IMAGES_PATH / f"{parent}.txt").exists()]
+        if missing_parents and commit_id not in shallow_ids:
+            problems.append(f"commit {commit_id}: missing parent {', '.join(missing_parents)}")
+        if commit_graph.get(commit_id, (0, None))[1] != [parent for parent in parents if parent not in missing_parents]:
+            problems.append(f"commit {commit_id}: not in the commit graph (or wrong parents), rebuild it by deleting {COMMIT_GRAPH_PATH.name}")
+        if metadata.get("tree"):
+            tree_ids[commit_id] = metadata["tree"]
+        elif (IMAGES_PATH / commit_id).is_dir():
+            problems.append(f"commit {commit_id}: image not migrated to the objects store, run wit migrate")
+        else:
+            problems.append(f"commit {commit_id}: no tree")
+        show_progress("Checking commits", done, len(commit_ids))
+    return tree_ids, problems, legacy_ids, len(commit_ids)
+
+
+def check_trees(tree_ids: list, checked_ids: set, missing_allowed: bool) -> tuple:
+    """Verify the tree objects reachable from tree_ids; returns (blob ids, verified tree ids, problems)."""
+    blob_ids = set()
+    verified_ids = []
+    problems = []
+    seen_ids = set()
+    stack = list(tree_ids)
+    while stack:
+        tree_id = stack.pop()
+        if tree_id in seen_ids:
+            continue
+        seen_ids.add(tree_id)
+        if not has_object(tree_id):
+            if not missing_allowed:
+                problems.append(f"tree {tree_id}: missing")
+            continue
+        try:
+            data = read_object(tree_id)
+            entries = [line.split(" ", 2) for line in data.decode().splitlines()]
+        except Exception as err:
+            problems.append(f"tree {tree_id}: unreadable ({err})")
+            continue
+        if tree_id not in checked_ids:
+            if hashlib.sha1(data).hexdigest() != tree_id:
+                problems.append(f"tree {tree_id}: content hashes to {hashlib.sha1(data).hexdigest()}")
+                continue
+            verified_ids.append(tree_id)
+        for entry in entries:
+            if len(entry) != 3 or entry[0] not in ("tree", "blob") or len(entry[1]) != 40:
+                problems.append(f"tree {tree_id}: bad entry {' '.join(entry)}")
+            elif entry[0] == "tree":
+                stack.append(entry[1])
+            else:
+                blob_ids.add(entry[1])
+        if len(seen_ids) % 1000 == 0:
+            sys.stderr.write(f"\rChecking trees: {len(seen_ids)}")
+    sys.stderr.write(f"\rChecking trees: {len(seen_ids)}\n")
+    return blob_ids, verified_ids, problems
+
+
+def fsck(resume: bool = False) -> None:
+    """Verify every commit's metadata and parents and every reachable object's content hash,
+    the objects in a process pool. Verified objects are appended to fsck.txt as they finish,
+    so fsck --resume after an interruption skips them; the file is removed when fsck completes."""
+    cwd_path = Path.cwd().absolute()
+    if not is_wit_dir_in_path(cwd_path):
+        log(f"Error - wit directory not found in -> {cwd_path}")
+        return
+    checked_ids = set(FSCK_PATH.read_text().split()) if resume and FSCK_PATH.exists() else set()
+    missing_allowed = bool(get_config("remote"))  # objects of a partial clone are fetched when needed
+    shallow_ids = set(SHALLOW_PATH.read_text().split()) if SHALLOW_PATH.exists() else set()
+    temp_paths = itertools.chain(IMAGES_PATH.glob("*.tmp"), OBJECTS_PATH.glob("tmp_*"))
+    problems = [f"interrupted write: {temp_path.relative_to(WIT_PATH)}" for temp_path in temp_paths]
+    with trace_span("fsck commits") as span:
+        tree_ids, commit_problems, legacy_ids, commit_count = check_commits(shallow_ids)
+        problems.extend(commit_problems)
+        span["files"] = commit_count
+    with open(str(FSCK_PATH), 'a' if resume else 'w') as progress_file:
+        with trace_span("fsck trees") as span:
+            blob_ids, verified_ids, tree_problems = check_trees(sorted(set(tree_ids.values())), checked_ids, missing_allowed)
+            problems.extend(tree_problems)
+            progress_file.writelines(f"{tree_id}\n" for tree_id in verified_ids)
+            span["files"] = len(verified_ids)
+        with trace_span("fsck objects") as span:
+            object_ids = sorted(blob_ids - checked_ids)
+            chunks = [object_ids[start:start + FSCK_CHUNK_SIZE] for start in range(0, len(object_ids), FSCK_CHUNK_SIZE)]
+            if len(chunks) <= 1:
+                results = (verify_objects(str(WIT_PATH), chunk) for chunk in chunks)
+            else:
+                from concurrent.futures import ProcessPoolExecutor  # imports multiprocessing, keep it off the startup path
+                executor = ProcessPoolExecutor()
+                results = executor.map(verify_objects, itertools.repeat(str(WIT_PATH)), chunks)
+            done = 0
+            for chunk, chunk_problems in zip(chunks, results):
+                problem_ids = {object_id for object_id, _problem in chunk_problems}
+                for object_id, problem in chunk_problems:
+                    if not (missing_allowed and problem == "missing"):
+                        problems.append(f"blob {object_id}: {problem}")
+                progress_file.writelines(f"{object_id}\n" for object_id in chunk if object_id not in problem_ids)
+                progress_file.flush()
+                done += len(chunk)
+                show_progress("Checking objects", done, len(object_ids))
+            if len(chunks) > 1:
+                executor.shutdown()
+            span["files"] = len(object_ids)
+    for problem in problems:
+        print(f"error: {problem}")
+    checked_before = len(blob_ids) - len(object_ids)
+    message = f"fsck: {commit_count} commits, {len(blob_ids)} blobs ({checked_before} checked before), {len(problems)} problems"
+    if legacy_ids:
+        sys.stderr.write(f"{legacy_ids} commits made before commit ids were content hashes, their ids can't be verified\n")
+    print(message)
+    if problems:
+        log(f"Error - {message}")
+    else:
+        FSCK_PATH.unlink()
+        log(f"Success - {message}")
+
+
+def get_working_path(relative_path: str) -> Path:
+    return get_working_root() / relative_path
+
+
+_session = {}  # while a session is open: {"index": dict, "index_changed": bool}
+
+
+@contextmanager
+def session():
+    """Run many commands in this process with the index kept in memory and written once at the
+    end, like references, config and the commit graph already are (wit batch, Repository)."""
+    if _session:  # nested, the outer session writes the index
+        yield
+        return
+    _session["active"] = True
+    try:
+        yield
+    finally:
+        index = _session.pop("index", None)
+        index_changed = _session.pop("index_changed", False)
+        _session.clear()
+        if index_changed:
+            save_index(index)
+        flush_log()
+
+
+def cache_session_index(index: dict) -> dict:
+    if _session:
+        _session["index"] = index
+    return index
+
+
+def load_index() -> dict:
+    """Read the index: {relative path: [staged blob id, size, mtime_ns, inode]}.
+
+    The stat values describe the working tree file the last time its content was known to
+    match the staged blob, so status only has to hash files whose stat data changed.
+    """
+    if "index" in _session:
+        return _session["index"]
+    if not INDEX_PATH.exists():
+        return cache_session_index(build_index_from_staging_area())
+    index = {}
+    try:
+        with trace_span("index read") as span, open(str(INDEX_PATH), 'r') as index_file:
+            for line in index_file:
+                relative_path, blob_id, size, mtime_ns, inode = line.rstrip("\n").split("\t")
+                index[relative_path] = [blob_id, int(size), int(mtime_ns), int(inode)]
+            span["files"] = len(index)
+    except Exception as err:
+        log(err)
+        return cache_session_index(build_index_from_staging_area())
+    return cache_session_index(index)
+
+
+def build_index_from_staging_area() -> dict:
+    index = {}
+    for relative_path in get_list_of_files_tree(str(STAGING_AREA_PATH)):
+        index[relative_path] = [hash_file(STAGING_AREA_PATH / relative_path), -1, 0, 0]  # unknown stat, hash on next status
+    return index
+
+
+def save_index(index: dict) -> None:
+    if _session:  # written once when the session ends
+        _session["index"] = index
+        _session["index_changed"] = True
+        return
+    temp_path = INDEX_PATH.with_name(f"index_{os.getpid()}.tmp")
+    try:
+        with trace_span("index write") as span, open(str(temp_path), 'w') as index_file:
+            span["files"] = len(index)
+            for relative_path in sorted(index):
+                blob_id, size, mtime_ns, inode = index[relative_path]
+                index_file.write(f"{relative_path}\t{blob_id}\t{size}\t{mtime_ns}\t{inode}\n")
+        os.replace(str(temp_path), str(INDEX_PATH))
+    except Exception as err:
+        log(err)
+
+
+def set_index_entry(index: dict, relative_path: str, blob_id: str, stat_result=None) -> None:
+    if stat_result is None or stat_result.st_mtime_ns >= time_module.time_ns() - 1_000_000_000:
+        # Unknown or "racy" stat: the file may change again within the mtime granularity, so
+        # keep only the hash and let the next status verify the content.
+        index[relative_path] = [blob_id, -1, 0, 0]
+    else:
+        index[relative_path] = [blob_id, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino]
+
+
+def is_stat_unchanged(entry: list, stat_result) -> bool:
+    return entry[1:] == [stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino]
 
 
 def get_activated_branch() -> str:
@@ -150,235 +1313,384 @@ def get_activated_branch() -> str:
         return ""
 
 
-def update_references_file(commit_id: str) -> None:
-    if not REFERENCES_PATH.exists():
-        try:
-            file = open(str(REFERENCES_PATH), 'w+')
-            file.write("HEAD=\nmaster=\nname=\n")
-        except PermissionError as err:
-            print(err)
-        finally:
-            file.close()
-    activated_branch = get_activated_branch()
+_references = {}
+
+
+def read_references_file() -> dict:
+    """{name: commit id} from references.txt lines "name=id"; HEAD first, then master and the branches."""
+    references = {}
     try:
-        with open(str(REFERENCES_PATH), 'r') as reference_file:
-            references_file_lines = reference_file.readlines()
+        with open(str(REFERENCES_PATH), 'r') as references_file:
+            for line in references_file:
+                name, _separator, commit_id = line.rstrip("\n").partition("=")
+                if name and (commit_id or name in ("HEAD", "master")):  # old files have an empty "name=" line
+                    references[name] = commit_id
+    except FileNotFoundError:
+        pass
     except Exception as err:
         log(err)
-    else:
-        update_branch_commit_id = references_file_lines[2][:references_file_lines[2].find('=')] == activated_branch
-        update_master_commit_id = activated_branch == "master"
-
-        references_file_lines[0] = references_file_lines[0][:5] + commit_id + "\n"  # new HEAD line
-        if update_master_commit_id:
-            references_file_lines[1] = references_file_lines[1][:7] + commit_id + "\n"  # new master line
-        if update_branch_commit_id:
-            references_file_lines[2] = f"{activated_branch}={commit_id}\n"
+    return references
+
+
+def load_references() -> dict:
+    """References are read once per process; update_references keeps the cache current."""
+    if not _references:
+        _references.update(read_references_file())
+    return _references
+
+
+def get_reference(name: str) -> str:
+    return load_references().get(name, "")
+
+
+@contextmanager
+def lock_references():
+    """Exclusive lock file, so concurrent wit processes update references.txt one at a time."""
+    deadline = time_module.monotonic() + LOCK_TIMEOUT
+    while True:
         try:
-            with open(str(REFERENCES_PATH), 'w') as reference_file_add:
-                reference_file_add.writelines(references_file_lines)
-        except Exception as err:
-            log(err)
+            lock_fd = os.open(str(REFERENCES_LOCK_PATH), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time_module.time() - REFERENCES_LOCK_PATH.stat().st_mtime > LOCK_STALE_AGE:
+                    REFERENCES_LOCK_PATH.unlink()
+                    continue
+            except FileNotFoundError:
+                continue
+            if time_module.monotonic() > deadline:
+                raise TimeoutError(errno.ETIMEDOUT, f"references are locked by another wit process -> {REFERENCES_LOCK_PATH}")
+            time_module.sleep(0.01)
+    try:
+        os.write(lock_fd, str(os.getpid()).encode())
+        os.close(lock_fd)
+        yield
+    finally:
+        REFERENCES_LOCK_PATH.unlink()
+
+
+def update_references(references_changes: dict, expected_references: dict = None) -> bool:
+    """Apply {name: commit id} under the lock, re-reading the file so changes made by other
+    processes are kept, and replace references.txt atomically. With expected_references
+    ({name: commit id}) nothing changes unless the references still have those values."""
+    try:
+        with trace_span("refs update") as span, lock_references():
+            references = {"HEAD": "", "master": ""}
+            references.update(read_references_file())
+            for name, commit_id in (expected_references or {}).items():
+                if references.get(name, "") != commit_id:
+                    log(f"Error - reference {name} moved to {references.get(name, '')}, expected {commit_id}")
+                    return False
+            references.update(references_changes)
+            temp_path = REFERENCES_PATH.with_name(f"references_{os.getpid()}.tmp")
+            with open(str(temp_path), 'w') as references_file:
+                references_file.writelines(f"{name}={commit_id}\n" for name, commit_id in references.items())
+            os.replace(str(temp_path), str(REFERENCES_PATH))
+            span["refs"] = len(references_changes)
+    except Exception as err:
+        log(err)
+        return False
+    _references.clear()
+    _references.update(references)
+    return True
+
+
+def is_local_branch(name: str) -> bool:
+    """remote/<name> references follow the remote and are checked out detached, like commit ids."""
+    return name == "master" or (name in load_references() and name != "HEAD" and not name.startswith("remote/"))
+
+
+def update_references_file(commit_id: str) -> None:
+    activated_branch = get_activated_branch()
+    references_changes = {"HEAD": commit_id}
+    if is_local_branch(activated_branch):
+        references_changes[activated_branch] = commit_id
+    update_references(references_changes)
 
 
 def commit(message: str, optional_commit_after_merge_branch_id=None) -> None:
     cwd_path = Path.cwd().absolute()
     if is_wit_dir_in_path(cwd_path):
-        commit_id = get_commit_id()
-        commit_path = IMAGES_PATH / commit_id
-        if not commit_path.exists():
-            commit_path.mkdir()
-            create_metadata_file(commit_id, message, IMAGES_PATH, optional_commit_after_merge_branch_id)
-            copy_content(STAGING_AREA_PATH, commit_path)
-            update_references_file(commit_id)
-        else:
-            commit(message)  # Until we get diffrent commit id
+        if optional_commit_after_merge_branch_id is None and MERGE_HEAD_PATH.exists():  # commit of a merge with fixed conflicts
+            optional_commit_after_merge_branch_id = MERGE_HEAD_PATH.read_text().strip()
+        with trace_span("write tree") as span:
+            tree_id = write_index_tree(load_index(), span)
+        with trace_span("commit metadata"):
+            commit_id, parents = create_metadata_file(message, IMAGES_PATH, optional_commit_after_merge_branch_id, tree_id)
+            if not commit_id:  # no image, HEAD and the commit graph stay as they are
+                return
+            add_commit_to_graph(commit_id, parents)
+        update_references_file(commit_id)
+        if MERGE_HEAD_PATH.exists():  # only once the merge commit is there, a failed commit can be retried
+            MERGE_HEAD_PATH.unlink()
     else:
         log(f"Error - wit directory not found in -> {cwd_path}")
 
 
 def get_list_of_files_tree(path: str):
-    files_path_list = []
-    for root, _dir, files in os.walk(path):
-        for file in files:
-            files_path_list.append(str(Path(root.replace(path, "")) / file))
-    return files_path_list
+    return [relative_path for relative_path, _entry in walk_files(Path(path))]
 
 
-def get_head_id() -> str:
-    head_id = ""
-    if REFERENCES_PATH.exists():
-        try:
-            with open(REFERENCES_PATH, 'r') as references_file:
-                head_line = references_file.readlines()[0]
-        except PermissionError as err:
-            log(err)
-        else:
-            head_id = head_line[5:-1]
-            return head_id
-    else:
-        log("Error - References file doesn't exist; do commit")
-    return head_id
+_ignore_patterns = {}
 
 
-def get_head_tree_path(head_id: str) -> str:
-    return str(IMAGES_PATH / head_id)
-   
+def load_ignore_patterns() -> tuple:
+    """Compile the .witignore of the working root, one glob per line, # for comments.
 
-def get_changes_to_be_commited(head_id: str) -> str:
-    head_tree_path = get_head_tree_path(head_id) 
-    head_tree = get_list_of_files_tree(head_tree_path)
-    stage_tree = get_list_of_files_tree(str(STAGING_AREA_PATH))
-    changes = set(stage_tree).difference(set(head_tree))
-    if ".DS_Store" in changes:  # operation system hidden file
-        changes.remove(".DS_Store")
-    return " \n".join(changes)
+    A pattern with a "/" matches the path from the working root, otherwise the name at any
+    depth; a trailing "/" matches only directories. Returns (names, paths, directory names,
+    directory paths) regexes, None when there are no such patterns. Hidden names are always
+    ignored. Cached by the mtime of the file, so it is read once per command.
+    """
+    ignore_path = get_working_path(".witignore")
+    try:
+        mtime_ns = ignore_path.stat().st_mtime_ns
+    except OSError:
+        mtime_ns = None
+    if _ignore_patterns.get("mtime_ns", 0) == mtime_ns:
+        return _ignore_patterns["patterns"]
+    groups = ([], [], [], [])
+    if mtime_ns is not None:
+        for line in ignore_path.read_text().splitlines():
+            pattern = line.strip()
+            if not pattern or pattern[0] == "#":
+                continue
+            directory_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            anchored = "/" in pattern
+            groups[2 * directory_only + anchored].append(fnmatch.translate(pattern.lstrip("/")))
+    patterns = tuple(re.compile("|".join(group)) if group else None for group in groups)
+    _ignore_patterns.update({"mtime_ns": mtime_ns, "patterns": patterns})
+    return patterns
+
+
+def is_ignored(relative_path: str, is_dir: bool, patterns: tuple) -> bool:
+    name = relative_path[relative_path.rfind("/") + 1:]
+    if name[0] == ".":
+        return True
+    name_regex, path_regex, directory_name_regex, directory_path_regex = patterns
+    if (name_regex and name_regex.match(name)) or (path_regex and path_regex.match(relative_path)):
+        return True
+    if is_dir:
+        return bool((directory_name_regex and directory_name_regex.match(name)) or (directory_path_regex and directory_path_regex.match(relative_path)))
+    return False
 
 
-def get_orginal_path() -> str:
-    lisr_dir_in_stage = os.listdir(str(STAGING_AREA_PATH))
-    for directory in lisr_dir_in_stage:
-        if directory[0] != ".":
-            return str(Path.home() / directory)
-    log("Error - orginal path not found")
-    return "orginal$not$found"
+def is_ignored_path(relative_path: str, patterns: tuple, is_dir: bool = False) -> bool:
+    """is_ignored for a path that was not reached by walk_files, checking its directories too."""
+    parts = relative_path.split("/")
+    return any(is_ignored("/".join(parts[:depth]), depth < len(parts) or is_dir, patterns) for depth in range(1, len(parts) + 1))
+
+
+def get_tracked_directories(tracked_paths) -> set:
+    """Every directory holding a tracked file, at any depth."""
+    tracked_directories = set()
+    for relative_path in tracked_paths:
+        directory = relative_path.rpartition("/")[0]
+        while directory and directory not in tracked_directories:
+            tracked_directories.add(directory)
+            directory = directory.rpartition("/")[0]
+    return tracked_directories
+
+
+def walk_files(directory: Path, relative_root: str = "", ignore_patterns: tuple = None, directories: bool = False, sparse_patterns: tuple = None, tracked_paths: dict = None):
+    """Yield (relative path, os.DirEntry) for every file under directory, with one scandir per
+    directory and no recursion. Relative paths start with relative_root; with ignore_patterns
+    ignored files are skipped and ignored directories are not entered, with sparse_patterns
+    only the sparse checkout paths are. Ignore rules are for untracked files only: the files of
+    tracked_paths (the index) and the directories holding them are always walked. With
+    directories, yield the sub directories too, before their content."""
+    tracked_paths = tracked_paths or {}
+    tracked_directories = None
+    stack = [(str(directory), relative_root, False)]
+    while stack:
+        path, relative_directory, in_ignored_directory = stack.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                relative_path = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                ignored = ignore_patterns is not None and (in_ignored_directory or is_ignored(relative_path, is_dir, ignore_patterns))
+                if ignored:
+                    if is_dir and tracked_directories is None:
+                        tracked_directories = get_tracked_directories(tracked_paths)
+                    if relative_path not in (tracked_directories if is_dir else tracked_paths):
+                        continue
+                if is_dir:
+                    if sparse_patterns is not None and not may_contain_sparse_paths(relative_path, sparse_patterns):
+                        continue
+                    if directories:
+                        yield relative_path, entry
+                    stack.append((entry.path, relative_path, ignored))
+                elif entry.is_file() and (sparse_patterns is None or is_sparse_path(relative_path, sparse_patterns)):
+                    yield relative_path, entry
 
 
-def get_first_staging_area_path() -> str:
-    lisr_dir_in_stage = os.listdir(str(STAGING_AREA_PATH))
-    for directory in lisr_dir_in_stage:
-        if directory[0] != ".":
-            return str(STAGING_AREA_PATH / directory)
-    log("Error - staging_area path not found")
-    return "staging_area$not$found"
+def get_head_id() -> str:
+    if not REFERENCES_PATH.exists():
+        log("Error - References file doesn't exist; do commit")
+    return get_reference("HEAD")
 
 
-def get_relative_path_for_staging(full_path: Path, orginal_path: str, staging_area_first_path: str) -> Path:
-    full_path_staging = Path(staging_area_first_path + str(full_path).replace(orginal_path, ""))
-    return full_path_staging
+def get_head_tree_files(head_id: str) -> dict:
+    tree_id = get_commit_tree_id(head_id) if head_id else ""
+    if not tree_id:
+        return {}
+    return get_tree_files(tree_id)
 
 
-def get_not_staged_files() -> str:
-    orginal_path = get_orginal_path()
-    staging_area_first_path = get_first_staging_area_path()
-    if orginal_path != "orginal$not$found" and staging_area_first_path != "orginal$not$found":
-        not_staged_files = []
-        if Path(staging_area_first_path).exists():
-                    diff_files = filecmp.dircmp(str(orginal_path), str(staging_area_first_path)).diff_files
-                    for diff_file in diff_files:
-                        if diff_file[0] != '.':
-                            not_staged_files.append(diff_file)
-        for root, dirs, _files in os.walk(str(orginal_path)):
-            for sub_dir in dirs:
-                full_path = Path(root) / sub_dir
-                full_path_staging = get_relative_path_for_staging(full_path, orginal_path, staging_area_first_path)
-                if full_path_staging.exists():
-                    diff_files = filecmp.dircmp(str(full_path), str(full_path_staging)).diff_files
-                    for diff_file in diff_files:
-                        if diff_file[0] != '.':
-                            not_staged_files.append(diff_file)
-        not_staged_files_clear = [not_staged_file for not_staged_file in not_staged_files if not_staged_file != ".DS_Store"]
-        return " ".join(not_staged_files_clear)
+def get_changes_to_be_commited(head_id: str, index: dict = None) -> str:
+    if index is None:
+        index = load_index()
+    index_tree_id, index_trees = get_index_trees(index)
+    head_tree_id = get_commit_tree_id(head_id) if head_id else ""
+    changes = [relative_path for relative_path, _head_blob_id, _index_blob_id in iter_tree_changes(head_tree_id, index_tree_id if index else "", unstored_trees=index_trees)]
+    changes = [change for change in changes if Path(change).name != ".DS_Store"]  # operation system hidden file
+    return " \n".join(sorted(changes))
 
-    else:
-        return "Error occurs while getting orginal folder path or staging area path - check the log file"
+
+def get_orginal_path() -> str:
+    """The directory status and the daemon look at: the working root, except for the
+    home directory repository of old versions, which tracks a single directory in it."""
+    if get_working_root() != Path.home():
+        return str(get_working_root())
+    lisr_dir_in_stage = [directory for directory in os.listdir(str(STAGING_AREA_PATH)) if directory[0] != "."]
+    if len(lisr_dir_in_stage) == 1 and (STAGING_AREA_PATH / lisr_dir_in_stage[0]).is_dir():
+        return str(get_working_root() / lisr_dir_in_stage[0])
+    if lisr_dir_in_stage:
+        return str(get_working_root())
+    log("Error - orginal path not found")
+    return "orginal$not$found"
 
 
-def get_untracked_files(head_id: str) -> str:
+def check_working_file(relative_path: str, full_path: Path, index: dict) -> str:
+    """"untracked", "not staged", "clean" or "refreshed" (clean, index stat updated)."""
+    entry = index.get(relative_path)
+    if entry is None:
+        return "untracked"
+    stat_result = full_path.stat()
+    if is_stat_unchanged(entry, stat_result):
+        return "clean"
+    blob_id = hash_file(full_path)
+    if blob_id != entry[0]:
+        return "not staged"
+    set_index_entry(index, relative_path, blob_id, stat_result)
+    return "refreshed"
+
+
+def scan_working_tree(index: dict, span: dict = None) -> tuple:
+    """One walk over the original path: returns (not staged files, untracked files).
+
+    Only files whose size, mtime or inode differ from the index are read and hashed; entries
+    whose content turns out unchanged get their stat refreshed so they are skipped next time.
+    span, when given, gets the number of files walked.
+    """
     orginal_path = get_orginal_path()
-    staging_area_first_path = get_first_staging_area_path()
-    if orginal_path != "orginal$not$found" and staging_area_first_path != "orginal$not$found":
-        untracked_files = []
-        if Path(staging_area_first_path).exists():
-                    only_on_orginal_files = filecmp.dircmp(str(orginal_path), str(staging_area_first_path)).left_only
-                    for file in only_on_orginal_files:
-                        untracked_files.append(file)
-        for root, dirs, _files in os.walk(str(orginal_path)):
-            for sub_dir in dirs:
-                full_path = Path(root) / sub_dir
-                full_path_staging = get_relative_path_for_staging(full_path, orginal_path, staging_area_first_path)
-                if full_path_staging.exists():
-                    only_on_orginal_files = filecmp.dircmp(str(full_path), str(full_path_staging)).left_only
-                    for file in only_on_orginal_files:
-                        untracked_files.append(file)
-                else:
-                    for _root2, _dirs2, files2 in os.walk(str(full_path)):
-                        for file2 in files2:
-                            untracked_files.append(file2)
-        return " ".join(untracked_files)
-    else:
+    if orginal_path == "orginal$not$found":
+        return None, None
+    not_staged_files = []
+    untracked_files = []
+    index_changed = False
+    seen_files = set()
+    ignore_patterns = load_ignore_patterns()
+    top_directory = get_working_relative_path(Path(orginal_path))
+    sparse_patterns = load_sparse_patterns()
+    for relative_path, entry in walk_files(Path(orginal_path), top_directory, ignore_patterns, sparse_patterns=sparse_patterns, tracked_paths=index):
+        seen_files.add(relative_path)
+        file_status = check_working_file(relative_path, Path(entry.path), index)
+        if file_status == "untracked":
+            untracked_files.append(relative_path)
+        elif file_status == "not staged":
+            not_staged_files.append(relative_path)
+        elif file_status == "refreshed":
+            index_changed = True
+    for relative_path in index:
+        if relative_path.startswith(top_directory + "/" if top_directory else "") and relative_path not in seen_files and (sparse_patterns is None or is_sparse_path(relative_path, sparse_patterns)):
+            not_staged_files.append(relative_path)  # deleted from the original path
+    if index_changed:
+        save_index(index)
+    if span is not None:
+        span["files"] = len(seen_files)
+    return sorted(not_staged_files), sorted(untracked_files)
+
+
+def get_not_staged_files(index: dict = None) -> str:
+    not_staged_files, _untracked_files = scan_working_tree(load_index() if index is None else index)
+    if not_staged_files is None:
         return "Error occurs while getting orginal folder path or staging area path - check the log file"
+    return " ".join(not_staged_files)
+
+
+def get_status_message(head_id: str, index: dict, not_staged_files: list, untracked_files: list) -> str:
+    message = ""
+    message += f"Current commit id (HEAD): {head_id}\n"
+    if not_staged_files is None:
+        error = "Error occurs while getting orginal folder path or staging area path - check the log file"
+        not_staged_files, untracked_files = [error], [error]
+    message += f"Changes to be commited: {get_changes_to_be_commited(head_id, index)}\n"
+    message += f"Changes not staged for commit: {' '.join(not_staged_files)}\n"
+    message += f"Untracked files: {' '.join(untracked_files)}"
+    return message
 
 
 def status():
+    response = daemon_request({"command": "status"}) if not _session else None
+    if response is not None:
+        print(response["output"])
+        return
     cwd_path = Path.cwd().absolute()
     if is_wit_dir_in_path(cwd_path):
-        message = ""
         head_id = get_head_id()
-        message += f"Current commit id (HEAD): {head_id}\n"
-        message += f"Changes to be commited: {get_changes_to_be_commited(head_id)}\n"
-        message += f"Changes not staged for commit: {get_not_staged_files()}\n"
-        message += f"Untracked files: {get_untracked_files(head_id)}"
-        print(message)
+        index = load_index()
+        with trace_span("walk") as span:
+            not_staged_files, untracked_files = scan_working_tree(index, span)
+        print(get_status_message(head_id, index, not_staged_files, untracked_files))
     else:
         log(f"Error - wit directory not found in -> {cwd_path}")
 
 
 def get_master_id() -> str:
-    master_id = ""
-    if REFERENCES_PATH.exists():
-        try:
-            with open(REFERENCES_PATH, 'r') as references_file:
-                master_line = references_file.readlines()[1]
-        except PermissionError as err:
-            log(err)
-        else:
-            master_id = master_line[7:-1]
-            return master_id
-    else:
+    if not REFERENCES_PATH.exists():
         log("Error - References file doesn't exist; do commit")
-    return master_id
-
-
-def copy_commit_id_content_to_orginal_path(commit_id: str) -> None:
-    orginal_path = Path(get_orginal_path())
-    shutil.rmtree(orginal_path)
-    commit_id_path = IMAGES_PATH / commit_id
-    shutil.copytree(str(commit_id_path), str(Path.home()))
-
-
-def copy_commit_id_to_staging_area(commit_id: str) -> None:
-    shutil.rmtree(str(STAGING_AREA_PATH))
-    commit_id_path = IMAGES_PATH / commit_id
-    shutil.copytree(str(commit_id_path), str(STAGING_AREA_PATH))
+    return get_reference("master")
+
+
+def update_orginal_path_and_staging_area(head_id: str, commit_id: str) -> bool:
+    """Write, update or delete only the paths that differ between HEAD and commit_id."""
+    tree_id = get_commit_tree_id(commit_id)
+    if not tree_id:
+        log(f"Error - commit id not found -> {commit_id}")
+        return False
+    with trace_span("tree diff") as span:
+        changed_files, deleted_files = get_tree_changes(get_commit_tree_id(head_id) if head_id else "", tree_id)
+        span["files"] = len(changed_files) + len(deleted_files)
+    working_changed_files, working_deleted_files = get_sparse_changes(changed_files, deleted_files, load_sparse_patterns())
+    with trace_span("write files") as span:
+        apply_tree_changes(working_changed_files, working_deleted_files, get_working_root())
+        apply_tree_changes(changed_files, deleted_files, STAGING_AREA_PATH, allow_hardlink=True)
+        span["files"] = len(working_changed_files) + len(working_deleted_files)
+    index = load_index()
+    for relative_path in deleted_files:
+        index.pop(relative_path, None)
+    for relative_path, blob_id in changed_files.items():
+        set_index_entry(index, relative_path, blob_id, get_working_path(relative_path).stat() if relative_path in working_changed_files else None)
+    save_index(index)
+    log(f"Success - checkout {commit_id}: {len(working_changed_files)} files written, {len(working_deleted_files)} files deleted")
+    return True
 
 
 def update_head_references_file(commit_id: str) -> None:
     if REFERENCES_PATH.exists():
-        for line in enumerate(fileinput.input(str(REFERENCES_PATH), inplace=1)):
-            if line[1][:line[1].find('=')] == "HEAD":
-                sys.stdout.write(line[1][:line[1].find('=') + 1] + commit_id)
-                sys.stdout.write("\n")
-            else:
-                sys.stdout.write(line[1])
+        update_references({"HEAD": commit_id})
     else:
         log(f"Error - references file not found on path {REFERENCES_PATH}")
 
 
-def update_activated_file() -> None:
+def update_activated_file(branch_name: str) -> None:
     try:
-        with open(str(REFERENCES_PATH), 'r') as references_file:
-            references_file_lines = references_file.readlines()
+        with open(str(ACTIVATED_PATH), 'w') as activated_file:
+            activated_file.write(branch_name)
     except Exception as err:
         log(err)
-    else:
-        if len(references_file_lines) == 3:  # there is branch to activate
-            branch_name = references_file_lines[2][:references_file_lines[2].find('=')]
-            try:
-                with open(str(ACTIVATED_PATH), 'w') as activated_file:
-                    activated_file.write(branch_name)
-            except Exception as err:
-                log(err)
 
 
 def checkout(commit_id: str) -> None:
@@ -386,31 +1698,154 @@ def checkout(commit_id: str) -> None:
     if is_wit_dir_in_path(cwd_path):
         head_id = get_head_id()
         if get_changes_to_be_commited(head_id) == "" and get_not_staged_files() == "":
-            if commit_id == "master":
-                commit_id = get_master_id()
-            else:
-                try:
-                    with open(str(REFERENCES_PATH), 'r') as references_file:
-                        references_file_lines = references_file.readlines()
-                except Exception as err:
-                    log(err)
-                else:
-                    if len(references_file_lines) == 3:  # there is branch to get his commit_id
-                        branch_name = references_file_lines[2][:references_file_lines[2].find('=')]
-                        if commit_id == branch_name:
-                            commit_id = references_file_lines[2][references_file_lines[2].find('=') + 1:-1]
-
-            copy_commit_id_content_to_orginal_path(commit_id)
-            copy_commit_id_to_staging_area(commit_id)
-            update_head_references_file(commit_id)
-            update_activated_file()
+            branch_name = ""
+            if commit_id != "HEAD" and get_reference(commit_id):
+                branch_name = commit_id if is_local_branch(commit_id) else ""
+                commit_id = get_reference(commit_id)
+            if update_orginal_path_and_staging_area(head_id, commit_id):
+                update_head_references_file(commit_id)
+                update_activated_file(branch_name)
         else:
             log("Error - there is changed files or new files in original path, the operation is invalid; Do add or commit before checkout")
     else:
         log(f"Error - wit directory not found in -> {cwd_path}")
 
 
+def get_relative_paths(paths: list) -> list:
+    """Command line paths (relative to the cwd, globs allowed) as paths from the working root;
+    None when one is outside the working root."""
+    relative_paths = []
+    for path in paths:
+        full_path = Path(os.path.abspath(path))  # also resolves ".."
+        if get_working_root() not in (full_path, *full_path.parents):
+            log(f"Error - path outside the working tree -> {path}")
+            return None
+        relative_paths.append(get_working_relative_path(full_path))
+    return relative_paths
+
+
+def checkout_paths(commit_id: str, paths: list) -> None:
+    """checkout <id> -- <paths>: restore only the files under paths from commit_id into the
+    original path, the staging area and the index; HEAD and the other files stay as they are."""
+    cwd_path = Path.cwd().absolute()
+    if is_wit_dir_in_path(cwd_path):
+        tree_id = get_commit_tree_id(resolve_commit_id(commit_id)) if resolve_commit_id(commit_id) else ""
+        if not tree_id:
+            log(f"Error - commit id not found -> {commit_id}")
+            return
+        relative_paths = get_relative_paths(paths)
+        if relative_paths is None:
+            return
+        path_patterns = compile_sparse_patterns(relative_paths)
+        index = load_index()
+        changed_files = {}
+        for relative_path, _old_id, blob_id in iter_tree_changes("", tree_id, path_patterns=path_patterns):
+            full_path = get_working_path(relative_path)
+            # Compare with the original path, not the index: the file may be outside the sparse
+            # checkout or locally edited, both are (re)written
+            if index.get(relative_path, [None])[0] == blob_id and full_path.is_file() and check_working_file(relative_path, full_path, index) in ("clean", "refreshed"):
+                continue
+            changed_files[relative_path] = blob_id
+        apply_tree_changes(changed_files, [], get_working_root())
+        apply_tree_changes(changed_files, [], STAGING_AREA_PATH, allow_hardlink=True)
+        for relative_path, blob_id in changed_files.items():
+            set_index_entry(index, relative_path, blob_id, get_working_path(relative_path).stat())
+        save_index(index)
+        log(f"Success - checkout {commit_id} -- {' '.join(paths)}: {len(changed_files)} files written")
+    else:
+        log(f"Error - wit directory not found in -> {cwd_path}")
+
+
+_sparse_patterns = {}
+
+
+def compile_sparse_patterns(patterns: list) -> tuple:
+    """(regex, literal prefixes) for paths from the working root or globs; a pattern matches
+    the path itself and everything under it, "" or "." (the working root) matches everything."""
+    patterns = [pattern.strip("/") for pattern in patterns]
+    if any(pattern in ("", ".") for pattern in patterns):
+        return re.compile(r"(?s:.*)\Z"), [""]
+    regexes = [fnmatch.translate(pattern) + "|" + fnmatch.translate(pattern + "/*") for pattern in patterns]
+    prefixes = []
+    for pattern in patterns:
+        literal_part = re.split(r"[*?[]", pattern, 1)[0]
+        prefixes.append(literal_part if literal_part == pattern else literal_part.rpartition("/")[0])  # directories before the first glob
+    return re.compile("|".join(regexes)), prefixes
+
+
+def load_sparse_patterns():
+    """The sparse checkout patterns of sparse.txt, compiled; None when the checkout is full."""
+    if "patterns" not in _sparse_patterns:
+        patterns = None
+        lines = [line for line in SPARSE_PATH.read_text().splitlines() if line.strip()] if SPARSE_PATH.exists() else []
+        if lines:  # an empty sparse.txt is a full checkout too
+            patterns = compile_sparse_patterns(lines)
+        _sparse_patterns["patterns"] = patterns
+    return _sparse_patterns["patterns"]
+
+
+def is_sparse_path(relative_path: str, sparse_patterns: tuple) -> bool:
+    return sparse_patterns[0].match(relative_path) is not None
+
+
+def may_contain_sparse_paths(relative_directory: str, sparse_patterns: tuple) -> bool:
+    return any(prefix == "" or (prefix + "/").startswith(relative_directory + "/") or relative_directory.startswith(prefix + "/") for prefix in sparse_patterns[1])
+
+
+def get_sparse_changes(changed_files: dict, deleted_files: list, sparse_patterns) -> tuple:
+    """The part of a tree change that goes to the original path; the staging area and the index
+    always get all of it, so commits keep the files that are not checked out."""
+    if sparse_patterns is None:
+        return changed_files, deleted_files
+    return ({relative_path: blob_id for relative_path, blob_id in changed_files.items() if is_sparse_path(relative_path, sparse_patterns)},
+            [relative_path for relative_path in deleted_files if is_sparse_path(relative_path, sparse_patterns)])
+
+
+def sparse(action: str, paths: list) -> None:
+    """sparse set <paths> / list / disable: choose the paths that are checked out in the original
+    path, removing the files that leave the checkout and restoring the ones that join it."""
+    cwd_path = Path.cwd().absolute()
+    if not is_wit_dir_in_path(cwd_path):
+        log(f"Error - wit directory not found in -> {cwd_path}")
+        return
+    if action == "list":
+        print(SPARSE_PATH.read_text() if SPARSE_PATH.exists() else "", end="")
+        return
+    if action not in ("set", "disable") or (action == "set" and not paths):
+        log(f"Error - invalid sparse action -> {action}; use set <paths>, list or disable")
+        return
+    relative_paths = get_relative_paths(paths) if action == "set" else []
+    if relative_paths is None:
+        return
+    head_id = get_head_id()
+    if get_changes_to_be_commited(head_id) != "" or get_not_staged_files() != "":
+        log("Error - there is changed files or new files in original path, the operation is invalid; Do add or commit before sparse")
+        return
+    old_patterns = load_sparse_patterns()
+    new_patterns = compile_sparse_patterns(relative_paths) if action == "set" else None
+    head_files = get_head_tree_files(head_id)
+    was_checked_out = set(get_sparse_changes(head_files, [], old_patterns)[0])
+    is_checked_out = set(get_sparse_changes(head_files, [], new_patterns)[0])
+    restored_files = {relative_path: head_files[relative_path] for relative_path in is_checked_out - was_checked_out}
+    apply_tree_changes(restored_files, sorted(was_checked_out - is_checked_out), get_working_root())
+    if action == "set":
+        temp_path = SPARSE_PATH.with_name(f"sparse_{os.getpid()}.tmp")
+        temp_path.write_text("".join(f"{relative_path or '.'}\n" for relative_path in relative_paths))
+        os.replace(str(temp_path), str(SPARSE_PATH))
+    elif SPARSE_PATH.exists():
+        SPARSE_PATH.unlink()
+    _sparse_patterns.clear()
+    index = load_index()
+    for relative_path in restored_files:
+        set_index_entry(index, relative_path, index[relative_path][0], get_working_path(relative_path).stat())
+    save_index(index)
+    log(f"Success - sparse {action}: {len(restored_files)} files restored, {len(was_checked_out - is_checked_out)} files removed")
+
+
 def get_parent_id(file_id: str) -> str:
+    commit_graph = load_commit_graph()
+    if file_id in commit_graph:
+        return ",".join(commit_graph[file_id][1]) or "None"
     file_name = file_id + ".txt"
     file_path = IMAGES_PATH / file_name
     try:
@@ -422,6 +1857,225 @@ def get_parent_id(file_id: str) -> str:
         return "None"
 
 
+_commit_graph = {}
+
+
+def load_commit_graph() -> dict:
+    """{commit id: (generation, [parent ids])}, read once per process from commit_graph.txt.
+
+    A commit's generation is one more than the highest generation of its parents, so every
+    ancestor of a commit has a smaller generation than the commit itself.
+    """
+    if _commit_graph:
+        return _commit_graph
+    if not COMMIT_GRAPH_PATH.exists():
+        return build_commit_graph()
+    try:
+        with open(str(COMMIT_GRAPH_PATH), 'r') as graph_file:
+            for line in graph_file:
+                commit_id, generation, parents = line.split()
+                _commit_graph[commit_id] = (int(generation), [] if parents == "None" else parents.split(","))
+    except Exception as err:
+        log(err)
+        _commit_graph.clear()
+        return build_commit_graph()
+    return _commit_graph
+
+
+def build_commit_graph() -> dict:
+    """Rebuild commit_graph.txt from the metadata files of images."""
+    commits_parents = {}
+    for metadata_path in IMAGES_PATH.glob("*.txt"):
+        try:
+            with open(str(metadata_path), 'r') as file:
+                parent_line = file.readline()
+        except Exception as err:
+            log(err)
+        else:
+            commits_parents[metadata_path.stem] = [parent for parent in parent_line[7:].strip().split(",") if parent not in ("None", "")]
+    _commit_graph.clear()
+    lines = []
+    for commit_id in commits_parents:
+        stack = [commit_id]
+        while stack:  # parents first, without recursion for long histories
+            current_id = stack[-1]
+            if current_id in _commit_graph:
+                stack.pop()
+                continue
+            parents = [parent for parent in commits_parents.get(current_id, []) if parent in commits_parents]
+            missing_parents = [parent for parent in parents if parent not in _commit_graph]
+            if missing_parents:
+                stack.extend(missing_parents)
+                continue
+            stack.pop()
+            generation = 1 + max((_commit_graph[parent][0] for parent in parents), default=0)
+            _commit_graph[current_id] = (generation, parents)
+            lines.append(f"{current_id} {generation} {','.join(parents) or 'None'}\n")
+    try:
+        with open(str(COMMIT_GRAPH_PATH), 'w') as graph_file:
+            graph_file.writelines(lines)
+    except Exception as err:
+        log(err)
+    return _commit_graph
+
+
+def add_commit_to_graph(commit_id: str, parents: list) -> None:
+    commit_graph = load_commit_graph()
+    if commit_id in commit_graph:  # already picked up while the graph file was rebuilt
+        return
+    generation = 1 + max((commit_graph[parent][0] for parent in parents if parent in commit_graph), default=0)
+    commit_graph[commit_id] = (generation, parents)
+    try:
+        with open(str(COMMIT_GRAPH_PATH), 'a') as graph_file:
+            graph_file.write(f"{commit_id} {generation} {','.join(parents) or 'None'}\n")
+    except Exception as err:
+        log(err)
+
+
+def get_commit_parents(commit_id: str) -> list:
+    commit_graph = load_commit_graph()
+    if commit_id in commit_graph:
+        return commit_graph[commit_id][1]
+    return [parent for parent in get_parent_id(commit_id).split(",") if parent != "None"]
+
+
+def get_merge_base(commit_id: str, other_commit_id: str) -> str:
+    """Best common ancestor: walk both histories by decreasing generation, the first commit
+    reached from both sides has no common ancestor of higher generation."""
+    commit_graph = load_commit_graph()
+    flags = {commit_id: 1}
+    flags[other_commit_id] = flags.get(other_commit_id, 0) | 2
+    queue = [(-commit_graph.get(current_id, (0, []))[0], current_id) for current_id in flags]
+    heapq.heapify(queue)
+    while queue:
+        _generation, current_id = heapq.heappop(queue)
+        current_flags = flags[current_id]
+        if current_flags == 3:
+            return current_id
+        for parent in get_commit_parents(current_id):
+            if parent not in flags:
+                flags[parent] = current_flags
+                heapq.heappush(queue, (-commit_graph.get(parent, (0, []))[0], parent))
+            else:
+                flags[parent] |= current_flags
+    return ""
+
+
+def iter_commits_topological(start_ids: list):
+    """Yield start_ids and all their ancestors (every parent of merges), children always before
+    their parents: the commit with the highest generation number comes out first."""
+    commit_graph = load_commit_graph()
+    queue = []
+    seen = set()
+    for commit_id in start_ids:
+        if commit_id and commit_id not in seen:
+            seen.add(commit_id)
+            heapq.heappush(queue, (-commit_graph.get(commit_id, (0, []))[0], commit_id))
+    while queue:
+        _generation, commit_id = heapq.heappop(queue)
+        yield commit_id
+        for parent in commit_graph[commit_id][1] if commit_id in commit_graph else get_commit_parents(commit_id):
+            if parent not in seen:
+                seen.add(parent)
+                heapq.heappush(queue, (-commit_graph.get(parent, (0, []))[0], parent))
+
+
+def get_commit_metadata(commit_id: str, images_dir: str = None) -> dict:
+    metadata = {}
+    try:
+        with open(f"{images_dir or IMAGES_PATH}/{commit_id}.txt", 'r') as file:  # no Path objects, log reads one file per commit
+            for line in file.read().splitlines():
+                key, _separator, value = line.partition("=")
+                metadata[key] = value
+    except Exception as err:
+        log(err)
+    return metadata
+
+
+def iter_log_lines(start_ids: list, draw_graph: bool, decorations: dict, oneline: bool = False):
+    """Stream one line per commit (plus connector lines with draw_graph), like git log --graph.
+
+    Each column holds the commit id expected next on that line of history, so a commit is
+    drawn in the column of its child and its parents take over or open columns. oneline
+    skips the date and message, which are the only per commit file reads.
+    """
+    columns = []
+    commit_graph = load_commit_graph()
+    images_dir = str(IMAGES_PATH)
+    for commit_id in iter_commits_topological(start_ids):
+        if commit_id not in columns:
+            columns.append(commit_id)
+        column = columns.index(commit_id)
+        decoration = f" ({', '.join(decorations[commit_id])})" if commit_id in decorations else ""
+        text = f"{commit_id}{decoration}"
+        if not oneline:
+            metadata = get_commit_metadata(commit_id, images_dir)
+            text += f" {metadata.get('date', '')} {metadata.get('message', '')}"
+        if not draw_graph:
+            yield text
+            continue
+        yield " ".join(["|"] * column + ["*"] + ["|"] * (len(columns) - column - 1)) + "  " + text
+        parents = commit_graph[commit_id][1] if commit_id in commit_graph else get_commit_parents(commit_id)
+        if len(parents) == 1 and parents[0] not in columns:  # straight line of history, the common case
+            columns[column] = parents[0]
+            continue
+        # The parents take the commit's column and the next ones, a parent already in a column
+        # on the right joins them here; one on the left keeps its column
+        moved_parents = [parent for parent in dict.fromkeys(parents) if parent not in columns or columns.index(parent) > column]
+        new_columns = columns[:column] + moved_parents + [column_id for column_id in columns[column + 1:] if column_id not in moved_parents]
+        edges = []
+        for index, column_id in enumerate(columns):
+            if index == column:
+                edges.extend((column, new_columns.index(parent)) for parent in dict.fromkeys(parents))
+            else:
+                edges.append((index, new_columns.index(column_id)))
+        if any(start != end for start, end in edges):
+            yield get_graph_connector(edges, max(len(columns), len(new_columns)))
+        columns = new_columns
+
+
+def get_graph_connector(edges: list, width: int) -> str:
+    """The line drawn between two commit lines for edges [(column before, column after)]: "|"
+    for a line of history that stays in its column, "/" next to the column a line leaves
+    towards the left and "\\" next to the column a line reaches from the left, with "_" over
+    the columns crossed on the way."""
+    connector = [" "] * (2 * width - 1)
+    for start, end in edges:
+        if start == end:
+            connector[2 * start] = "|"
+        elif end < start:
+            connector[2 * start - 1] = "/"
+            for position in range(2 * end + 1, 2 * start - 1, 2):
+                connector[position] = "_" if connector[position] == " " else connector[position]
+        else:
+            connector[2 * end - 1] = "\\"
+            for position in range(2 * start + 1, 2 * end - 1, 2):
+                connector[position] = "_" if connector[position] == " " else connector[position]
+    return "".join(connector).rstrip()
+
+
+def show_log(draw_graph: bool, limit: int = None, skip: int = 0, oneline: bool = False) -> None:
+    cwd_path = Path.cwd().absolute()
+    if is_wit_dir_in_path(cwd_path):
+        references = load_references()
+        decorations = {}
+        for name, commit_id in references.items():
+            decorations.setdefault(commit_id, []).append(name)
+        start_ids = [references.get("HEAD", "")] + [commit_id for name, commit_id in references.items() if name != "HEAD"]
+        lines = itertools.islice(iter_log_lines(start_ids, draw_graph, decorations, oneline), skip, None if limit is None else skip + limit)
+        try:
+            while True:  # stream in pages, the history is never fully in memory
+                page = list(itertools.islice(lines, LOG_PAGE_SIZE))
+                if not page:
+                    break
+                sys.stdout.write("\n".join(page) + "\n")
+                sys.stdout.flush()
+        except BrokenPipeError:  # ex. piped to head
+            pass
+    else:
+        log(f"Error - wit directory not found in -> {cwd_path}")
+
+
 def get_commits_edges() -> list:
     chars_to_show = 6
     edges = []
@@ -429,34 +2083,57 @@ def get_commits_edges() -> list:
     master_id = get_master_id()
     edges.append(('head', head_id[:chars_to_show]))
     edges.append(('master', master_id[:chars_to_show]))
-    child_id = head_id
-    parent_id = get_parent_id(head_id)
-    while parent_id != "None":
-        parents = parent_id.split(',')
-        for parent in parents:
+    for child_id in iter_commits_topological([head_id]):
+        for parent in get_commit_parents(child_id):
             edges.append((child_id[:chars_to_show], parent[:chars_to_show]))
-            
-        child_id = parents[0]  # continue with heads
-        parent_id = get_parent_id(parents[0])
     return edges
 
 
-def graph() -> None:
+def get_graph_layout(edges: list) -> dict:
+    """Layered positions: one row per generation, so the layout is linear in the history size
+    instead of spring_layout's O(n^2) iterations."""
+    commit_graph = load_commit_graph()
+    generations = {commit_id[:6]: generation for commit_id, (generation, _parents) in commit_graph.items()}
+    rows = {}
+    layout = {}
+    for src_node, dest_node in edges:
+        for node in (dest_node, src_node):
+            if node not in layout:
+                generation = generations.get(node, generations.get(dest_node, 0) + 1)
+                rows[generation] = rows.get(generation, 0) + 1
+                layout[node] = (rows[generation], generation)
+    return layout
+
+
+def graph(output_path: str = None) -> None:
     cwd_path = Path.cwd().absolute()
     if is_wit_dir_in_path(cwd_path):
         edges = get_commits_edges()
+        try:
+            import matplotlib
+            if output_path:
+                matplotlib.use("Agg")  # render offscreen, no display needed
+            import matplotlib.pyplot as plt  # heavy, only graph needs them
+            import networkx as nx
+        except ImportError as err:
+            log(f"Error - graph requires matplotlib and networkx -> {err}")
+            return
         try:
             G = nx.DiGraph()
             for relation in edges:
                 src_node = relation[0]
                 dest_node = relation[1]
                 G.add_edge(src_node, dest_node) 
-            pos = nx.spring_layout(G)  # compute graph layout
+            pos = get_graph_layout(edges)  # compute graph layout
             nx.draw(G, pos, node_size=3000)  # draw nodes and edges
             nx.draw_networkx_labels(G, pos)  # draw node labels/names
             labels = nx.get_edge_attributes(G, 'wit graph')
             nx.draw_networkx_edge_labels(G, pos, edge_labels=labels)
-            plt.show()
+            if output_path:
+                plt.savefig(output_path)  # format from the extension, ex. .svg / .png
+                plt.close()
+            else:
+                plt.show()
         except Exception as err:
             log(err)
     else:
@@ -464,112 +2141,1086 @@ def graph() -> None:
 
 
 def change_references_file(name: str) -> None:
-    head_id = get_head_id()
-    try:
-        with open(str(REFERENCES_PATH), 'r') as reference_file:
-            references_file_lines = reference_file.readlines()
-    except Exception as err:
-        log(err)
-    else:
-        references_file_lines[2] = f"{name}={head_id}\n"
-        try:
-            with open(str(REFERENCES_PATH), 'w') as reference_file:
-                reference_file.writelines(references_file_lines)
-        except Exception as err:
-            log(err)
+    if name == "HEAD":
+        log("Error - HEAD is not a valid branch name")
+        return
+    update_references({name: get_head_id()})
 
 
 def branch(name: str) -> None:
     cwd_path = Path.cwd().absolute()
     if is_wit_dir_in_path(cwd_path):
+        if name == "HEAD" or name.startswith("remote/"):
+            log(f"Error - {name} is reserved, choose another branch name")
+            return
         change_references_file(name)
     else:
         log(f"Error - wit directory not found in -> {cwd_path}")
 
 
-def get_branch_id() -> str:
-    try:
-        with open(str(REFERENCES_PATH), 'r') as reference_file:
-            return reference_file.readlines()[2][reference_file.readlines()[2].find('=') + 1:-1]  # verify \n or not [7:-1]
-    except Exception as err:
-        log(err)
-
-
-def get_parents(commit_id: str) -> list:
-    parents = []
-    parent_id = get_parent_id(commit_id)
-    while parent_id != "None":
-        parents.append(parent_id)
-        parent_id = get_parent_id(parent_id)
-    return parents
+def get_branch_id(name: str) -> str:
+    branch_id = get_reference(name) if name != "HEAD" else ""
+    if not branch_id:
+        log(f"Error - branch not found -> {name}")
+    return branch_id
+
+
+def get_line_matches(lines: list, other_lines: list) -> list:
+    """Myers O(ND) diff: [(index in lines, index in other_lines)] of the lines both keep."""
+    prefix = 0
+    while prefix < len(lines) and prefix < len(other_lines) and lines[prefix] == other_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < len(lines) - prefix and suffix < len(other_lines) - prefix and lines[-1 - suffix] == other_lines[-1 - suffix]:
+        suffix += 1
+    matches = [(line_index, line_index) for line_index in range(prefix)]
+    a = lines[prefix:len(lines) - suffix]
+    b = other_lines[prefix:len(other_lines) - suffix]
+    n, m = len(a), len(b)
+    middle_matches = []
+    if n and m:
+        furthest = {1: 0}
+        trace = []
+        found = False
+        for distance in range(n + m + 1):
+            trace.append(dict(furthest))
+            for diagonal in range(-distance, distance + 1, 2):
+                if diagonal == -distance or (diagonal != distance and furthest[diagonal - 1] < furthest[diagonal + 1]):
+                    x = furthest[diagonal + 1]
+                else:
+                    x = furthest[diagonal - 1] + 1
+                y = x - diagonal
+                while x < n and y < m and a[x] == b[y]:
+                    x += 1
+                    y += 1
+                furthest[diagonal] = x
+                if x >= n and y >= m:
+                    found = True
+                    break
+            if found:
+                break
+        x, y = n, m
+        for distance in range(len(trace) - 1, -1, -1):
+            furthest = trace[distance]
+            diagonal = x - y
+            if diagonal == -distance or (diagonal != distance and furthest[diagonal - 1] < furthest[diagonal + 1]):
+                previous_diagonal = diagonal + 1
+            else:
+                previous_diagonal = diagonal - 1
+            previous_x = furthest[previous_diagonal]
+            previous_y = previous_x - previous_diagonal
+            while x > previous_x and y > previous_y:
+                x -= 1
+                y -= 1
+                middle_matches.append((x + prefix, y + prefix))
+            x, y = previous_x, previous_y
+        middle_matches.reverse()
+    matches.extend(middle_matches)
+    matches.extend((len(lines) - suffix + line_index, len(other_lines) - suffix + line_index) for line_index in range(suffix))
+    return matches
+
+
+def merge_lines(base_lines: list, head_lines: list, branch_lines: list, branch_name: str) -> tuple:
+    """diff3: copy the regions both sides kept from base, resolve the changed regions between
+    them; returns (merged lines, True if some region was changed differently on both sides)."""
+    head_matches = dict(get_line_matches(base_lines, head_lines))
+    branch_matches = dict(get_line_matches(base_lines, branch_lines))
+    merged_lines = []
+    has_conflict = False
+    base_index = head_index = branch_index = 0
+    while True:
+        stable_index = base_index
+        while stable_index < len(base_lines) and not (stable_index in head_matches and stable_index in branch_matches):
+            stable_index += 1
+        if stable_index < len(base_lines):
+            head_end, branch_end = head_matches[stable_index], branch_matches[stable_index]
+        else:
+            head_end, branch_end = len(head_lines), len(branch_lines)
+        base_chunk = base_lines[base_index:stable_index]
+        head_chunk = head_lines[head_index:head_end]
+        branch_chunk = branch_lines[branch_index:branch_end]
+        if head_chunk == branch_chunk or branch_chunk == base_chunk:
+            merged_lines.extend(head_chunk)
+        elif head_chunk == base_chunk:
+            merged_lines.extend(branch_chunk)
+        else:
+            has_conflict = True
+            for marker, chunk in ((b"<<<<<<< HEAD\n", head_chunk), (b"=======\n", branch_chunk)):
+                merged_lines.append(marker)
+                merged_lines.extend(chunk)
+                if chunk and not chunk[-1].endswith(b"\n"):  # keep the last line from gluing to a marker
+                    merged_lines[-1] += b"\n"
+            merged_lines.append(f">>>>>>> {branch_name}\n".encode())
+        if stable_index >= len(base_lines):
+            return merged_lines, has_conflict
+        merged_lines.append(base_lines[stable_index])
+        base_index, head_index, branch_index = stable_index + 1, head_end + 1, branch_end + 1
+
+
+def merge_file_content(base_data: bytes, head_data: bytes, branch_data: bytes, branch_name: str) -> tuple:
+    """Returns (merged content, has conflict); binary files can't be merged by lines."""
+    if b"\0" in base_data or b"\0" in head_data or b"\0" in branch_data:
+        return head_data, True
+    base_lines = base_data.splitlines(keepends=True)
+    head_lines = head_data.splitlines(keepends=True)
+    branch_lines = branch_data.splitlines(keepends=True)
+    merged_lines, has_conflict = merge_lines(base_lines, head_lines, branch_lines, branch_name)
+    return b"".join(merged_lines), has_conflict
+
+
+def get_merge_tree_files(base_tree_id: str, head_tree_id: str, branch_tree_id: str) -> tuple:
+    """The base, HEAD and branch blob ids of the paths the branch changed since the base, the
+    only ones a merge can change. Sub trees with the same id on both sides are not read."""
+    base_files = {}
+    branch_files = {}
+    for relative_path, base_id, branch_id in iter_tree_changes(base_tree_id, branch_tree_id):
+        base_files[relative_path] = base_id
+        branch_files[relative_path] = branch_id
+    head_files = dict(branch_files)  # where HEAD and the branch don't differ
+    for relative_path, head_id, _branch_id in iter_tree_changes(head_tree_id, branch_tree_id):
+        if relative_path in branch_files:
+            head_files[relative_path] = head_id
+    return tuple({relative_path: blob_id for relative_path, blob_id in files.items() if blob_id is not None} for files in (base_files, head_files, branch_files))
+
+
+def merge_trees(base_files: dict, head_files: dict, branch_files: dict, branch_name: str) -> tuple:
+    """Three-way merge by blob ids; only paths changed differently on both sides are read and
+    merged line by line (in parallel). Returns ({path: blob id} merged tree, {path: content} conflicts)."""
+    merged_files = {}
+    to_merge = []
+    conflicts = {}
+    for relative_path in set(head_files) | set(branch_files):
+        base_id = base_files.get(relative_path)
+        head_id = head_files.get(relative_path)
+        branch_id = branch_files.get(relative_path)
+        if head_id == branch_id or branch_id == base_id:
+            merged_id = head_id
+        elif head_id == base_id:
+            merged_id = branch_id
+        elif head_id is None or branch_id is None:
+            merged_id = head_id  # deleted on one side, changed on the other
+            log(f"Error - merge conflict (deleted and changed) -> {relative_path}")
+            conflicts[relative_path] = read_object(head_id or branch_id)
+        else:
+            to_merge.append(relative_path)
+            merged_id = head_id
+        if merged_id is not None:
+            merged_files[relative_path] = merged_id
+    if to_merge:
+        arguments = [(read_object(base_files[path]) if path in base_files else b"", read_object(head_files[path]), read_object(branch_files[path]), branch_name) for path in to_merge]
+        if len(to_merge) == 1:
+            results = [merge_file_content(*arguments[0])]
+        else:
+            from concurrent.futures import ProcessPoolExecutor  # imports multiprocessing, keep it off the startup path
+            with ProcessPoolExecutor() as executor:
+                results = list(executor.map(merge_file_content, *zip(*arguments)))
+        for relative_path, (merged_data, has_conflict) in zip(to_merge, results):
+            if has_conflict:
+                conflicts[relative_path] = merged_data
+            else:
+                merged_files[relative_path] = write_object(merged_data)
+    return merged_files, conflicts
 
 
-def get_changed_files(branch_id: str, common_parent_id: str) -> list:
-    branch_path = IMAGES_PATH / branch_id
-    common_parent_path = IMAGES_PATH / common_parent_id
-    not_staged_files = []
-    if Path(branch_path).exists():
-        diff_files = filecmp.dircmp(str(branch_path), str(common_parent_path)).diff_files
-        for diff_file in diff_files:
-            if diff_file[0] != '.':
-                not_staged_files.append(branch_path + diff_file)
-    for root, dirs, _files in os.walk(str(branch_path)):
-        for sub_dir in dirs:
-            full_path = Path(root) / sub_dir
-            full_path_common = get_relative_path_for_staging(full_path, str(branch_path), str(common_parent_path))
-            if full_path_common.exists():
-                diff_files = filecmp.dircmp(str(full_path), str(full_path_common)).diff_files
-                for diff_file in diff_files:
-                    if diff_file[0] != '.':
-                        not_staged_files.append(str(full_path / diff_file))
-    return not_staged_files
-
-
-def move_changed_files_to_staging_area(changed_files_list: list, branch_id: str) -> None:
-    for changed_file in changed_files_list:
-        relative_path_in_staging_area = get_relative_path_for_staging(Path(changed_file), str(IMAGES_PATH / branch_id), str(STAGING_AREA_PATH))
-        if relative_path_in_staging_area.exists():
+def merge(beanch_name: str) -> None:
+    cwd_path = Path.cwd().absolute()
+    if is_wit_dir_in_path(cwd_path):
+        head_id = get_head_id()
+        if get_changes_to_be_commited(head_id) != "" or get_not_staged_files() != "":
+            log("Error - there is changed files or new files in original path, the operation is invalid; Do add or commit before merge")
+            return
+        branch_id = get_branch_id(beanch_name)
+        if not branch_id:
+            return
+        common_parent_id = get_merge_base(head_id, branch_id)
+        if not common_parent_id:
+            log(f"Error - no common parent for {head_id} and {branch_id}")
+            return
+        if common_parent_id == branch_id:
+            log(f"Error - {beanch_name} is already merged")
+            return
+        with trace_span("merge trees") as span:
+            base_files, head_files, branch_files = get_merge_tree_files(get_commit_tree_id(common_parent_id), get_commit_tree_id(head_id), get_commit_tree_id(branch_id))
+            merged_files, conflicts = merge_trees(base_files, head_files, branch_files, beanch_name)
+            changed_files = {relative_path: blob_id for relative_path, blob_id in merged_files.items() if head_files.get(relative_path) != blob_id}
+            deleted_files = [relative_path for relative_path in head_files if relative_path not in merged_files]
+            span["files"] = len(changed_files) + len(deleted_files)
+            span["conflicts"] = len(conflicts)
+        working_changed_files, working_deleted_files = get_sparse_changes(changed_files, deleted_files, load_sparse_patterns())
+        with trace_span("write files") as span:
+            apply_tree_changes(working_changed_files, working_deleted_files, get_working_root())
+            apply_tree_changes(changed_files, deleted_files, STAGING_AREA_PATH, allow_hardlink=True)
+            span["files"] = len(working_changed_files) + len(working_deleted_files)
+        index = load_index()
+        for relative_path in deleted_files:
+            index.pop(relative_path, None)
+        for relative_path, blob_id in changed_files.items():
+            set_index_entry(index, relative_path, blob_id, get_working_path(relative_path).stat() if relative_path in working_changed_files else None)
+        save_index(index)
+        if conflicts:
+            for relative_path, content in conflicts.items():  # only in the original path, to fix and add
+                get_working_path(relative_path).parent.mkdir(parents=True, exist_ok=True)  # also outside the sparse checkout
+                with open(str(get_working_path(relative_path)), 'wb') as conflict_file:
+                    conflict_file.write(content)
             try:
-                relative_path_in_staging_area.unlink()
+                with open(str(MERGE_HEAD_PATH), 'w') as merge_head_file:
+                    merge_head_file.write(branch_id)
             except Exception as err:
                 log(err)
+            print(f"Merge conflicts: {' '.join(sorted(conflicts))}")
+            log(f"Error - merge conflicts in {len(conflicts)} files; fix them, add and commit")
+        else:
+            commit("automatic commit after merge", branch_id)
+    else:
+        log(f"Error - wit directory not found in -> {cwd_path}")
+
+
+def resolve_commit_id(name: str) -> str:
+    """A branch name, HEAD or a commit id as the commit id; "" when there is no such commit."""
+    commit_id = get_reference(name) or name
+    return commit_id if (IMAGES_PATH / f"{commit_id}.txt").exists() else ""
+
+
+def get_diff_changes(commit_ids: list, cached: bool, path_patterns) -> tuple:
+    """What wit diff compares: two commits, a commit (HEAD with --cached) and the index, a
+    commit and the original path, or the index and the original path (no commits). Returns
+    (old label, new label, iterator of (relative path, old source, new source)); a source is
+    ("blob", id), ("file", path) or None. Files come from the index stat cache and hashes,
+    only the changed ones are read."""
+    if len(commit_ids) == 2:
+        tree_ids = [get_commit_tree_id(commit_id) for commit_id in commit_ids]
+        changes = ((relative_path, old_id and ("blob", old_id), new_id and ("blob", new_id)) for relative_path, old_id, new_id in iter_tree_changes(tree_ids[0], tree_ids[1], path_patterns=path_patterns))
+        return commit_ids[0], commit_ids[1], changes
+    index = load_index()
+    if cached:
+        commit_id = commit_ids[0] if commit_ids else get_head_id()
+        index_tree_id, index_trees = get_index_trees(index)
+        tree_changes = iter_tree_changes(get_commit_tree_id(commit_id) if commit_id else "", index_tree_id if index else "", path_patterns=path_patterns, unstored_trees=index_trees)
+        changes = ((relative_path, old_id and ("blob", old_id), new_id and ("file", STAGING_AREA_PATH / relative_path)) for relative_path, old_id, new_id in tree_changes)
+        return commit_id, "index", changes
+    sparse_patterns = load_sparse_patterns()
+    old_files = get_head_tree_files(commit_ids[0]) if commit_ids else {relative_path: entry[0] for relative_path, entry in index.items()}
+    changes = []
+    index_changed = False
+    for relative_path in sorted(old_files.keys() | index.keys()):
+        if (path_patterns is not None and not is_sparse_path(relative_path, path_patterns)) or (sparse_patterns is not None and not is_sparse_path(relative_path, sparse_patterns)):
+            continue
+        full_path = get_working_path(relative_path)
+        old_source = None
+        if relative_path in old_files:
+            old_source = ("blob", old_files[relative_path]) if commit_ids else ("file", STAGING_AREA_PATH / relative_path)
+        if not full_path.is_file():
+            if old_source is not None:
+                changes.append((relative_path, old_source, None))
+            continue
+        file_status = check_working_file(relative_path, full_path, index)
+        index_changed = index_changed or file_status == "refreshed"
+        working_blob_id = index[relative_path][0] if file_status in ("clean", "refreshed") else hash_file(full_path)
+        if working_blob_id != old_files.get(relative_path):
+            changes.append((relative_path, old_source, ("file", full_path)))
+    if index_changed:
+        save_index(index)
+    return commit_ids[0] if commit_ids else "index", "working tree", iter(changes)
+
+
+def read_diff_source(source) -> bytes:
+    if source is None:
+        return b""
+    source_type, value = source
+    if source_type == "blob":
+        return read_object(value)
+    with open(str(value), 'rb') as file:
+        return file.read()
+
+
+def is_binary(data: bytes) -> bool:
+    return b"\0" in data[:8000]  # like git: a NUL byte near the start
+
+
+def iter_diff_lines(changes, old_label: str, new_label: str):
+    """Unified diff text of every change, one file at a time, so a large diff is never in
+    memory as a whole."""
+    import difflib  # only diff needs it, keep it off the startup path
+    for relative_path, old_source, new_source in changes:
+        old_data, new_data = read_diff_source(old_source), read_diff_source(new_source)
+        old_name = f"a/{relative_path}" if old_source else "/dev/null"
+        new_name = f"b/{relative_path}" if new_source else "/dev/null"
+        yield f"diff --wit a/{relative_path} b/{relative_path}\n"
+        if is_binary(old_data) or is_binary(new_data):
+            yield f"Binary files {old_name} and {new_name} differ\n"
+            continue
+        old_lines = old_data.decode(errors="replace").splitlines(keepends=True)
+        new_lines = new_data.decode(errors="replace").splitlines(keepends=True)
+        for line in difflib.unified_diff(old_lines, new_lines, f"{old_name}\t({old_label})", f"{new_name}\t({new_label})"):
+            yield line if line.endswith("\n") else line + "\n\\ No newline at end of file\n"
+
+
+def iter_diff_stat_lines(changes):
+    """--stat: changed lines per file and a total, from a diff without context lines."""
+    import difflib
+    files_count = insertions = deletions = 0
+    for relative_path, old_source, new_source in changes:
+        files_count += 1
+        old_data, new_data = read_diff_source(old_source), read_diff_source(new_source)
+        if is_binary(old_data) or is_binary(new_data):
+            yield f" {relative_path} | Bin {len(old_data)} -> {len(new_data)} bytes\n"
+            continue
+        file_insertions = file_deletions = 0
+        for line in difflib.unified_diff(old_data.decode(errors="replace").splitlines(), new_data.decode(errors="replace").splitlines(), n=0, lineterm=""):
+            if line.startswith("+") and not line.startswith("+++"):
+                file_insertions += 1
+            elif line.startswith("-") and not line.startswith("---"):
+                file_deletions += 1
+        insertions += file_insertions
+        deletions += file_deletions
+        yield f" {relative_path} | {file_insertions + file_deletions} {'+' * min(file_insertions, 40)}{'-' * min(file_deletions, 40)}\n"
+    yield f" {files_count} files changed, {insertions} insertions(+), {deletions} deletions(-)\n"
+
+
+def diff(commit_names: list, paths: list, cached: bool = False, stat_only: bool = False) -> None:
+    """diff [--cached] [--stat] [A [B]] [-- paths]"""
+    cwd_path = Path.cwd().absolute()
+    if not is_wit_dir_in_path(cwd_path):
+        log(f"Error - wit directory not found in -> {cwd_path}")
+        return
+    commit_ids = [resolve_commit_id(commit_name) for commit_name in commit_names[:2]]
+    if not all(commit_ids):
+        log(f"Error - commit id not found -> {' '.join(commit_names)}")
+        return
+    relative_paths = get_relative_paths(paths)
+    if relative_paths is None:
+        return
+    path_patterns = compile_sparse_patterns(relative_paths) if paths else None
+    old_label, new_label, changes = get_diff_changes(commit_ids, cached, path_patterns)
+    lines = iter_diff_stat_lines(changes) if stat_only else iter_diff_lines(changes, old_label, new_label)
+    output = sys.stdout
+    for page in iter(lambda: list(itertools.islice(lines, LOG_PAGE_SIZE)), []):
+        output.write("".join(page))
+    output.flush()
+
+
+def write_pack_stream(entries, stream) -> int:
+    """Send pack entries as one stream: the signature, framed entries and an all zero id."""
+    count = 0
+    stream.write(PACK_SIGNATURE)
+    for object_id, entry_type, base_id, payload in entries:
+        stream.write(PACK_STREAM_ENTRY.pack(bytes.fromhex(object_id), entry_type, len(payload)) + (bytes.fromhex(base_id) if base_id else b"") + payload)
+        count += 1
+    stream.write(bytes(20))
+    stream.flush()
+    return count
+
+
+def read_pack_stream(stream, counters: dict):
+    """Yield the entries of write_pack_stream as they arrive; counters gets objects and bytes."""
+    if stream.read(len(PACK_SIGNATURE)) != PACK_SIGNATURE:
+        raise ValueError("invalid pack stream")
+    while True:
+        raw_id = stream.read(20)
+        if raw_id == bytes(20):
+            return
+        entry_type, length = PACK_STREAM_ENTRY.unpack(raw_id + stream.read(PACK_STREAM_ENTRY.size - 20))[1:]
+        base_id = stream.read(20).hex() if entry_type == PACK_DELTA else None
+        payload = stream.read(length)
+        counters["objects"] = counters.get("objects", 0) + 1
+        counters["bytes"] = counters.get("bytes", 0) + len(payload)
+        yield raw_id.hex(), entry_type, base_id, payload
+
+
+def collect_pack_objects(tree_ids: list, excluded_tree_ids: list, object_ids: list) -> tuple:
+    """Objects under tree_ids (newest first) and object_ids that are not under excluded_tree_ids,
+    the trees of commits the other side has. Returns ([tree ids], {relative path: [blob ids]})."""
+    excluded = set()
+    stack = [tree_id for tree_id in excluded_tree_ids if tree_id]
+    while stack:
+        current_tree_id = stack.pop()
+        if current_tree_id in excluded or not has_object(current_tree_id):
+            continue
+        excluded.add(current_tree_id)
+        for object_type, object_id, _name in read_tree(current_tree_id):
+            if object_type == "tree":
+                stack.append(object_id)
             else:
-                try: 
-                    shutil.copyfile(changed_file, str(relative_path_in_staging_area))
-                except Exception as err:
-                    log(err)     
+                excluded.add(object_id)
+    seen = set(excluded)
+    pack_tree_ids = []
+    blobs_by_path = {}
+    for tree_id in tree_ids:
+        stack = [("", tree_id)]
+        while stack:
+            prefix, current_tree_id = stack.pop()
+            if current_tree_id in seen or not has_object(current_tree_id):
+                continue
+            seen.add(current_tree_id)
+            pack_tree_ids.append(current_tree_id)
+            for object_type, object_id, name in read_tree(current_tree_id):
+                if object_type == "tree":
+                    stack.append((prefix + name + "/", object_id))
+                elif object_id not in seen and has_object(object_id):
+                    seen.add(object_id)
+                    blobs_by_path.setdefault(prefix + name, []).append(object_id)
+    for object_id in object_ids:
+        if object_id not in seen and has_object(object_id):
+            seen.add(object_id)
+            blobs_by_path[object_id] = [object_id]
+    return pack_tree_ids, blobs_by_path
+
+
+def get_remote_wit_path(path: str) -> Path:
+    """A remote is another wit directory on a local path, given as it or as its parent."""
+    remote_path = Path(path).expanduser().absolute()
+    return remote_path / ".wit" if (remote_path / ".wit").is_dir() else remote_path
+
+
+def start_remote_command(remote_wit_path: Path, args: list) -> "subprocess.Popen":
+    """Run wit on the remote side, like a user of that repository would, with pipes for the
+    request and the pack stream."""
+    import subprocess  # only the remote commands need it, keep it off the startup path
+    env = dict(os.environ, WIT_DIR=str(remote_wit_path))
+    env.pop("WIT_TRACE", None)
+    return subprocess.Popen([sys.executable, str(Path(__file__).absolute())] + args, cwd=str(remote_wit_path.parent), env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+
+def get_remote_advertisement(remote_wit_path: Path) -> dict:
+    """{references, activated branch, commit graph} of the remote, to find what is missing."""
+    import json
+    process = start_remote_command(remote_wit_path, ["upload-pack", "advertise"])
+    output, _errors = process.communicate()
+    if process.returncode != 0 or not output:
+        raise RuntimeError(f"no wit repository in remote -> {remote_wit_path}")
+    return json.loads(output)
+
+
+def upload_pack(action: str = "") -> None:
+    """Remote side of fetch: advertise, or read a request from stdin and answer with a header
+    line ({images: {commit id: metadata}, generations}) and one pack stream on stdout."""
+    import json
+    output = sys.stdout.buffer
+    if action == "advertise":
+        commit_graph = load_commit_graph()
+        advertisement = {"references": dict(load_references()), "activated": get_activated_branch(), "graph": {commit_id: [generation, parents] for commit_id, (generation, parents) in commit_graph.items()}}
+        output.write(json.dumps(advertisement).encode())
+        output.flush()
+        return
+    request = json.loads(sys.stdin.buffer.readline())
+    images = {}
+    for commit_id in request.get("commits", []):
+        try:
+            images[commit_id] = (IMAGES_PATH / f"{commit_id}.txt").read_text()
+        except Exception as err:
+            log(err)
+    tree_ids = [get_commit_tree_id(commit_id) for commit_id in request.get("commit_trees", [])] + request.get("trees", [])
+    excluded_tree_ids = [get_commit_tree_id(commit_id) for commit_id in request.get("haves", []) if commit_id in load_commit_graph()]
+    pack_tree_ids, blobs_by_path = collect_pack_objects([tree_id for tree_id in tree_ids if tree_id], excluded_tree_ids, request.get("objects", []))
+    generations = {commit_id: load_commit_graph().get(commit_id, (0, []))[0] for commit_id in images}
+    output.write(json.dumps({"images": images, "generations": generations}).encode() + b"\n")
+    count = write_pack_stream(compress_pack_entries(pack_tree_ids, blobs_by_path), output)
+    log(f"Success - upload-pack: {len(images)} commits, {count} objects")
+
+
+def receive_pack_stream(stream) -> tuple:
+    """Store a header line and pack stream (from upload-pack or push); returns (header, counters).
+    The pack goes in first, so an image is never visible without its objects."""
+    import json
+    header = json.loads(stream.readline())
+    counters = {}
+    entries = (entry for entry in read_pack_stream(stream, counters) if not has_object(entry[0]))
+    first_entry = next(entries, None)
+    if first_entry is not None:  # None also when we had every object already
+        write_pack(itertools.chain([first_entry], entries))
+    for _pack_path, index_map, _count in _packs:
+        index_map.close()
+    _packs.clear()
+    images = header.get("images", {})
+    commit_graph = load_commit_graph()
+    for commit_id, metadata in images.items():
+        temp_path = IMAGES_PATH / f"{commit_id}_{os.getpid()}.tmp"
+        temp_path.write_text(metadata)
+        os.replace(str(temp_path), str(IMAGES_PATH / f"{commit_id}.txt"))
+    metadata_parents = {commit_id: [parent for parent in metadata.splitlines()[0][7:].split(",") if parent not in ("None", "")] for commit_id, metadata in images.items()}
+    for commit_id in sorted(metadata_parents, key=lambda new_commit_id: header.get("generations", {}).get(new_commit_id, 0)):
+        add_commit_to_graph(commit_id, [parent for parent in metadata_parents[commit_id] if parent in commit_graph or parent in images])  # parents first
+    return header, counters
+
+
+def fetch_pack(remote_wit_path: Path, request: dict) -> tuple:
+    import json
+    with trace_span("fetch pack") as span:
+        process = start_remote_command(remote_wit_path, ["upload-pack"])
+        process.stdin.write(json.dumps(request).encode() + b"\n")
+        process.stdin.close()
+        try:
+            header, counters = receive_pack_stream(process.stdout)
+        except ValueError:  # no header line, upload-pack failed before answering
+            header, counters = None, {}
+        process.stdout.close()
+        if process.wait() != 0 or header is None:
+            raise RuntimeError(f"upload-pack failed in remote -> {remote_wit_path}")
+        span.update(counters)
+    return header, counters
+
+
+def fetch_missing_objects(tree_ids: list = (), object_ids: list = ()) -> None:
+    """Lazy fetch: bring objects a shallow clone skipped from the remote, with HEAD's tree
+    as what is already here."""
+    remote = get_config("remote")
+    if not remote:
+        return
+    head_id = get_reference("HEAD")
+    missing_ids = " ".join(list(tree_ids) + list(object_ids))
+    request = {"trees": list(tree_ids), "objects": list(object_ids), "haves": [head_id] if head_id else []}
+    try:
+        _header, counters = fetch_pack(get_remote_wit_path(remote), request)
+    except (OSError, ValueError, RuntimeError) as err:
+        log(f"Error - object {missing_ids} not available, remote unreachable: {err}")
+        raise SystemExit(1)  # nothing to read further down, the command stops here
+    not_fetched_ids = [object_id for object_id in list(tree_ids) + list(object_ids) if not has_object(object_id)]
+    if not_fetched_ids:
+        log(f"Error - object {' '.join(not_fetched_ids)} not available in remote -> {remote}")
+        raise SystemExit(1)
+    log(f"Success - lazy fetch of {missing_ids}: {counters.get('objects', 0)} objects")
+
+
+def get_missing_commits(remote_graph: dict, tip_ids: list, depth: int = None) -> tuple:
+    """Walk the remote commit graph from tip_ids down to the commits we have, at most depth
+    commits deep. Returns ([missing commit ids], [commit ids we have that they build on])."""
+    commit_graph = load_commit_graph()
+    missing = set()
+    haves = set()
+    level_ids = [tip_id for tip_id in tip_ids if tip_id and tip_id not in commit_graph]
+    level = 0
+    while level_ids and (depth is None or level < depth):
+        next_level_ids = []
+        for commit_id in level_ids:
+            if commit_id in missing:
+                continue
+            missing.add(commit_id)
+            for parent in remote_graph.get(commit_id, [0, []])[1]:
+                if parent in commit_graph:
+                    haves.add(parent)
+                elif parent not in missing:
+                    next_level_ids.append(parent)
+        level_ids = next_level_ids
+        level += 1
+    return sorted(missing, key=lambda commit_id: -remote_graph[commit_id][0]), sorted(haves)
+
+
+def update_shallow_file() -> None:
+    """shallow.txt lists the commits whose parents were not fetched; history stops there."""
+    commit_graph = load_commit_graph()
+    shallow_ids = [commit_id for commit_id, (_generation, parents) in commit_graph.items() if len(parents) < len(get_commit_parents_from_image(commit_id))]
+    if shallow_ids:
+        SHALLOW_PATH.write_text("".join(f"{commit_id}\n" for commit_id in sorted(shallow_ids)))
+    elif SHALLOW_PATH.exists():
+        SHALLOW_PATH.unlink()
+
+
+def get_commit_parents_from_image(commit_id: str) -> list:
+    metadata = get_commit_metadata(commit_id)
+    return [parent for parent in metadata.get("parent", "None").split(",") if parent not in ("None", "")]
+
+
+def fetch_remote(depth: int = None) -> dict:
+    """Fetch the branches of the remote as remote/<name> references; returns the advertisement."""
+    remote_wit_path = get_remote_wit_path(get_config("remote"))
+    advertisement = get_remote_advertisement(remote_wit_path)
+    remote_graph = advertisement["graph"]
+    branches = {name: commit_id for name, commit_id in advertisement["references"].items() if name != "HEAD" and commit_id and not name.startswith("remote/")}
+    missing_ids, have_ids = get_missing_commits(remote_graph, list(branches.values()), depth)
+    request = {
+        "commits": missing_ids,
+        "commit_trees": [commit_id for commit_id in branches.values() if commit_id in missing_ids] if depth else missing_ids,  # older trees come lazily
+        "haves": have_ids,
+    }
+    header, counters = fetch_pack(remote_wit_path, request) if missing_ids else ({"images": {}}, {})
+    if depth or SHALLOW_PATH.exists():
+        update_shallow_file()
+    update_references({f"remote/{name}": commit_id for name, commit_id in branches.items()})
+    message = f"Fetched {len(header['images'])} commits, {counters.get('objects', 0)} objects ({counters.get('bytes', 0)} bytes) from {remote_wit_path}"
+    print(message)
+    log(f"Success - {message}")
+    return advertisement
+
+
+def fetch(depth: int = None) -> None:
+    cwd_path = Path.cwd().absolute()
+    if is_wit_dir_in_path(cwd_path):
+        if not get_config("remote"):
+            log("Error - no remote; set one with: config remote PATH")
+            return
+        try:
+            fetch_remote(depth)
+        except Exception as err:
+            log(f"Error - fetch failed: {err}")
+    else:
+        log(f"Error - wit directory not found in -> {cwd_path}")
+
+
+def clone(remote: str, depth: int = None) -> None:
+    """Create a wit repository in the working directory from remote's, checking out its master;
+    with depth only the last depth commits come, and only the objects of the branch tips."""
+    remote_wit_path = get_remote_wit_path(remote)
+    use_repository(Path(os.environ.get("WIT_DIR") or Path.cwd() / ".wit").absolute())
+    if WIT_PATH.exists():
+        log(f"Error - a wit directory already exists -> {WIT_PATH}")
+        return
+    if not (remote_wit_path / "images").is_dir():
+        log(f"Error - no wit repository in remote -> {remote_wit_path}")
+        return
+    init()
+    set_config("remote", str(remote_wit_path))
+    try:
+        advertisement = fetch_remote(depth)
+    except Exception as err:
+        log(f"Error - clone failed: {err}")
+        return
+    master_id = advertisement["references"].get("master", "")
+    update_references({"HEAD": master_id, "master": master_id})
+    if master_id:
+        update_orginal_path_and_staging_area("", master_id)
+
+
+def push() -> None:
+    """Send the commits of the activated branch that the remote is missing, with their objects in
+    one pack, and move the remote branch if it is an ancestor (fast forward)."""
+    import json
+    cwd_path = Path.cwd().absolute()
+    if not is_wit_dir_in_path(cwd_path):
+        log(f"Error - wit directory not found in -> {cwd_path}")
+        return
+    if not get_config("remote"):
+        log("Error - no remote; set one with: config remote PATH")
+        return
+    remote_wit_path = get_remote_wit_path(get_config("remote"))
+    branch_name = get_activated_branch()
+    if not is_local_branch(branch_name):
+        log("Error - HEAD is detached, checkout the branch to push first")
+        return
+    commit_id = get_reference(branch_name)
+    try:
+        advertisement = get_remote_advertisement(remote_wit_path)
+    except Exception as err:
+        log(f"Error - push failed: {err}")
+        return
+    remote_graph = advertisement["graph"]
+    remote_commit_id = advertisement["references"].get(branch_name, "")
+    if advertisement["activated"] == branch_name:
+        log(f"Error - {branch_name} is checked out in the remote, push to another branch")
+        return
+    if not commit_id or remote_commit_id == commit_id:
+        print("Everything up to date")
+        return
+    commit_graph = load_commit_graph()
+    if remote_commit_id and (remote_commit_id not in commit_graph or get_merge_base(commit_id, remote_commit_id) != remote_commit_id):
+        log(f"Error - remote {branch_name} has commits that are not here; fetch and merge first")
+        return
+    missing_ids = set()
+    have_ids = set()
+    stack = [commit_id]
+    while stack:  # down to the commits the remote has
+        current_id = stack.pop()
+        if current_id in missing_ids:
+            continue
+        missing_ids.add(current_id)
+        for parent in commit_graph.get(current_id, (0, []))[1]:
+            if parent in remote_graph:
+                have_ids.add(parent)
+            elif parent not in missing_ids:
+                stack.append(parent)
+    images = {missing_id: (IMAGES_PATH / f"{missing_id}.txt").read_text() for missing_id in missing_ids}
+    missing_ids = sorted(missing_ids, key=lambda missing_id: -commit_graph.get(missing_id, (0, []))[0])
+    pack_tree_ids, blobs_by_path = collect_pack_objects([get_commit_tree_id(missing_id) for missing_id in missing_ids], [get_commit_tree_id(have_id) for have_id in have_ids], [])
+    process = start_remote_command(remote_wit_path, ["receive-pack"])
+    header = {"images": images, "generations": {missing_id: commit_graph.get(missing_id, (0, []))[0] for missing_id in missing_ids}, "references": {branch_name: commit_id}, "expected": {branch_name: remote_commit_id}}
+    process.stdin.write(json.dumps(header).encode() + b"\n")
+    count = write_pack_stream(compress_pack_entries(pack_tree_ids, blobs_by_path), process.stdin)
+    process.stdin.close()
+    result = process.stdout.read().decode()
+    process.wait()
+    if result != "ok":
+        log(f"Error - push rejected: {result}")
+        print(f"Push rejected: {result}")
+        return
+    update_references({f"remote/{branch_name}": commit_id})
+    message = f"Pushed {len(missing_ids)} commits, {count} objects to {remote_wit_path} {branch_name}"
+    print(message)
+    log(f"Success - {message}")
+
+
+def receive_pack() -> None:
+    """Remote side of push: store the pack and the images, then move the references if nobody
+    moved them meanwhile. Answers "ok" or the reason on stdout."""
+    header, counters = receive_pack_stream(sys.stdin.buffer)
+    if update_references(header["references"], header["expected"]):
+        sys.stdout.write("ok")
+        log(f"Success - receive-pack: {len(header['images'])} commits, {counters.get('objects', 0)} objects, {header['references']}")
+    else:
+        sys.stdout.write("references changed in the remote meanwhile, fetch and push again")
+
+
+def daemon_request(request: dict):
+    """Send a request to a running daemon; None when there is none, so the caller does the work."""
+    if not DAEMON_SOCKET_PATH.exists():
+        return None
+    import json
+    import socket  # only with a daemon running, keep it off the startup path
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(DAEMON_TIMEOUT)
+            client.connect(str(DAEMON_SOCKET_PATH))
+            client.sendall(json.dumps(request).encode() + b"\n")
+            client.shutdown(socket.SHUT_WR)
+            response = b"".join(iter(lambda: client.recv(65536), b""))
+        return json.loads(response)
+    except ConnectionRefusedError:
+        DAEMON_SOCKET_PATH.unlink()  # left by a daemon that was killed
+        return None
+    except (OSError, ValueError) as err:
+        log(f"Error - daemon not answering, working without it -> {err}")
+        return None
+
+
+def reset_process_caches() -> None:
+    """Forget what other wit processes may have changed since (a long running daemon)."""
+    _references.clear()
+    _config.clear()
+    _commit_graph.clear()
+    _sparse_patterns.clear()
+    _ignore_patterns.clear()
+    for _pack_path, index_map, _count in _packs:
+        index_map.close()
+    _packs.clear()
+
+
+def create_inotify():
+    """(libc, inotify fd) on linux, None elsewhere; the daemon then rescans on every request."""
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (ImportError, OSError, AttributeError) as err:
+        log(f"Error - inotify not available, polling instead -> {err}")
+        return None
+    if inotify_fd < 0:
+        log("Error - inotify_init1 failed, polling instead")
+        return None
+    return libc, inotify_fd
+
+
+def watch_directory(daemon_state: dict, directory: Path) -> None:
+    """Watch directory and its sub directories, and mark the files in them to check."""
+    relative_root = get_working_relative_path(directory)
+    watched_directories = [(relative_root, str(directory))]
+    for relative_path, entry in walk_files(directory, relative_root, load_ignore_patterns(), directories=True, tracked_paths=daemon_state["index"]):
+        if entry.is_dir(follow_symlinks=False):
+            watched_directories.append((relative_path, entry.path))
         else:
-            log(f"Error - couldn't find staging area file -> {relative_path_in_staging_area}")
+            daemon_state["dirty"].add(relative_path)
+    if daemon_state["inotify"] is not None:
+        libc, inotify_fd = daemon_state["inotify"]
+        for relative_path, path in watched_directories:
+            watch_descriptor = libc.inotify_add_watch(inotify_fd, os.fsencode(path), INOTIFY_MASK)
+            if watch_descriptor >= 0:
+                daemon_state["watches"][watch_descriptor] = relative_path
 
 
-def merge(beanch_name: str) -> None:
+def read_inotify_events(daemon_state: dict) -> None:
+    _libc, inotify_fd = daemon_state["inotify"]
+    try:
+        data = os.read(inotify_fd, 1024 * 1024)
+    except BlockingIOError:
+        return
+    offset = 0
+    while offset < len(data):
+        watch_descriptor, mask, _cookie, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+        name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + name_length].rstrip(b"\0").decode(errors="surrogateescape")
+        offset += INOTIFY_EVENT.size + name_length
+        if mask & IN_Q_OVERFLOW:
+            daemon_state["rescan"] = True
+            continue
+        if mask & IN_IGNORED:
+            daemon_state["watches"].pop(watch_descriptor, None)
+            continue
+        directory = daemon_state["watches"].get(watch_descriptor)
+        if directory is None or not name:
+            continue
+        relative_path = f"{directory}/{name}" if directory else name
+        if relative_path not in daemon_state["index"] and is_ignored_path(relative_path, load_ignore_patterns(), bool(mask & IN_ISDIR)):
+            if not mask & IN_ISDIR or relative_path not in get_tracked_directories(daemon_state["index"]):
+                continue
+        if mask & IN_ISDIR:
+            full_path = get_working_path(relative_path)
+            if full_path.is_dir():
+                watch_directory(daemon_state, full_path)
+            prefix = relative_path + "/"
+            daemon_state["dirty"].update(known_path for known_path in daemon_state["files"] if known_path.startswith(prefix))
+        else:
+            daemon_state["dirty"].add(relative_path)
+
+
+def refresh_daemon_state(daemon_state: dict) -> None:
+    """Reload the index when another process changed it, then check only the dirty files."""
+    try:
+        index_mtime = INDEX_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        index_mtime = 0
+    ignore_patterns = load_ignore_patterns()
+    if _ignore_patterns["mtime_ns"] != daemon_state["ignore_mtime"]:  # .witignore changed; the patterns are compiled again for every request
+        daemon_state["ignore_mtime"] = _ignore_patterns["mtime_ns"]
+        daemon_state["files"].clear()
+        daemon_state["rescan"] = True
+    if index_mtime != daemon_state["index_mtime"]:
+        old_index = daemon_state["index"]
+        daemon_state["index"] = load_index()
+        daemon_state["index_mtime"] = index_mtime
+        daemon_state["dirty"].update(daemon_state["files"])
+        daemon_state["dirty"].update(relative_path for relative_path in daemon_state["index"] if relative_path.startswith(daemon_state["top_directory"]))
+        if any(relative_path not in old_index and is_ignored_path(relative_path, ignore_patterns) for relative_path in daemon_state["index"]):
+            daemon_state["rescan"] = True  # newly tracked files in ignored directories, not watched yet
+    if daemon_state["inotify"] is None or daemon_state["rescan"]:
+        daemon_state["watches"].clear()
+        daemon_state["dirty"].update(daemon_state["files"])
+        daemon_state["dirty"].update(relative_path for relative_path in daemon_state["index"] if relative_path.startswith(daemon_state["top_directory"]))  # deleted ones aren't walked
+        watch_directory(daemon_state, Path(daemon_state["orginal_path"]))
+        daemon_state["rescan"] = False
+    index = daemon_state["index"]
+    for relative_path in daemon_state["dirty"]:
+        daemon_state["files"].pop(relative_path, None)
+        full_path = get_working_path(relative_path)
+        if full_path.is_file():
+            daemon_state["files"][relative_path] = check_working_file(relative_path, full_path, index)
+        elif relative_path in index:
+            daemon_state["files"][relative_path] = "deleted"
+    daemon_state["dirty"].clear()
+
+
+def get_daemon_status(daemon_state: dict) -> str:
+    refresh_daemon_state(daemon_state)
+    sparse_patterns = load_sparse_patterns()
+    files = {relative_path: file_status for relative_path, file_status in daemon_state["files"].items() if sparse_patterns is None or is_sparse_path(relative_path, sparse_patterns)}
+    not_staged_files = sorted(relative_path for relative_path, file_status in files.items() if file_status in ("not staged", "deleted"))
+    untracked_files = sorted(relative_path for relative_path, file_status in files.items() if file_status == "untracked")
+    return get_status_message(get_head_id(), daemon_state["index"], not_staged_files, untracked_files)
+
+
+def handle_daemon_request(daemon_state: dict, request: dict) -> dict:
+    import io
+    from contextlib import redirect_stdout
+    reset_process_caches()
+    output = io.StringIO()
+    with redirect_stdout(output):
+        if request.get("command") == "status":
+            return {"output": get_daemon_status(daemon_state)}
+        if request.get("command") == "add":
+            add_path(request["path"])
+            return {"output": output.getvalue()}
+        if request.get("command") == "stop":
+            daemon_state["running"] = False
+            return {"output": "wit daemon stopped"}
+    return {"output": f"Error - unknown daemon request -> {request}"}
+
+
+def run_daemon() -> None:
+    """Serve status / add requests on daemon.sock, keeping the working tree state in memory."""
+    import json
+    import select
+    import socket
+    orginal_path = get_orginal_path()
+    if orginal_path == "orginal$not$found" or not hasattr(socket, "AF_UNIX"):
+        log("Error - daemon can't start, no original path or no unix sockets")
+        return
+    load_ignore_patterns()  # for the .witignore mtime
+    daemon_state = {
+        "inotify": create_inotify(),
+        "orginal_path": orginal_path,
+        "top_directory": (get_working_relative_path(Path(orginal_path)) + "/").lstrip("/"),
+        "watches": {},
+        "files": {},  # relative path -> untracked / not staged / deleted / clean / refreshed
+        "dirty": set(),
+        "index": load_index(),
+        "index_mtime": None,
+        "rescan": False,
+        "ignore_mtime": _ignore_patterns["mtime_ns"],
+        "running": True,
+    }
+    watch_directory(daemon_state, Path(orginal_path))
+    if DAEMON_SOCKET_PATH.exists():
+        DAEMON_SOCKET_PATH.unlink()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(DAEMON_SOCKET_PATH))
+    server.listen()
+    log(f"Success - wit daemon {os.getpid()} watching {orginal_path}")
+    try:
+        while daemon_state["running"]:
+            watched = [server] + ([daemon_state["inotify"][1]] if daemon_state["inotify"] else [])
+            readable, _writable, _errors = select.select(watched, [], [])
+            if daemon_state["inotify"] and daemon_state["inotify"][1] in readable:
+                read_inotify_events(daemon_state)
+            if server in readable:
+                connection, _address = server.accept()
+                with connection:
+                    request_data = b"".join(iter(lambda: connection.recv(65536), b""))
+                    try:
+                        response = handle_daemon_request(daemon_state, json.loads(request_data))
+                    except Exception as err:
+                        log(err)
+                        response = {"output": f"Error - {err}"}
+                    connection.sendall(json.dumps(response).encode())
+                flush_log()
+    finally:
+        server.close()
+        DAEMON_SOCKET_PATH.unlink()
+        log(f"Success - wit daemon {os.getpid()} stopped")
+
+
+def daemon(action: str) -> None:
     cwd_path = Path.cwd().absolute()
     if is_wit_dir_in_path(cwd_path):
-        head_id = get_head_id()
-        branch_id = get_branch_id()
-        head_parents = get_parents(head_id)
-        branch_parents = get_parents(branch_id)
-        for head_parent in head_parents:
-            if head_parent in branch_parents:
-                common_parent_id = head_parent
-                break
-        changed_files_list = get_changed_files(branch_id, common_parent_id)
-        move_changed_files_to_staging_area(changed_files_list, branch_id)
-        commit("automatic commit after merge", branch_id)
+        if action == "run":
+            run_daemon()
+        elif action == "start":
+            import subprocess
+            subprocess.Popen([sys.executable, str(Path(__file__).absolute()), "daemon", "run"], cwd=str(cwd_path), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        elif action == "stop":
+            response = daemon_request({"command": "stop"})
+            if response is None:
+                log("Error - no wit daemon running")
+        else:
+            log(f"Error - invalid daemon action -> {action}; use start, stop or run")
     else:
         log(f"Error - wit directory not found in -> {cwd_path}")
 
 
-if __name__ == "__main__":
-    argvs = sys.argv
-    print(argvs)
-    if len(argvs) == 2:
+def batch() -> None:
+    """Run the commands on stdin, one per line as on the command line without "wit" (ex. add
+    a.txt), in this process and one session: 1000 adds and a commit cost one start up."""
+    with session():
+        for line in sys.stdin:
+            args = shlex.split(line, comments=True)
+            if not args or args[0] in ("batch", "upload-pack", "receive-pack"):
+                continue
+            try:
+                run_command(["wit"] + args)
+            except Exception as err:
+                print(f"Error - {line.strip()}: {err}")
+                log(f"Error - batch {line.strip()}: {err}")
+
+
+class Repository:
+    """Python API for scripts: every method runs the command of the same name in this process
+    and returns what it prints. Inside a with block the commands share one session:
+
+        with Repository("/home/me/project") as repository:
+            for path in paths:
+                repository.add(path)
+            repository.commit("many files")
+    """
+
+    def __init__(self, path: str = "."):
+        self.path = Path(path).absolute()
+        self._previous_cwd = None
+        self._session = None
+
+    def __enter__(self):
+        self._previous_cwd = os.getcwd()
+        os.chdir(str(self.path))  # commands find the repository from the working directory
+        self._session = session()
+        self._session.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            self._session.__exit__(*exc_info)
+        finally:
+            os.chdir(self._previous_cwd)
+            self._previous_cwd = None
+        return False
+
+    def run(self, *args) -> str:
+        if self._previous_cwd is None:
+            with self:
+                return self.run(*args)
+        import io
+        from contextlib import redirect_stdout
+        output = io.StringIO()
+        with redirect_stdout(output):
+            run_command(["wit"] + [str(arg) for arg in args])
+        return output.getvalue()
+
+    def add(self, path: str) -> str:
+        return self.run("add", path)
+
+    def commit(self, message: str) -> str:
+        return self.run("commit", message)
+
+    def status(self) -> str:
+        return self.run("status")
+
+    def checkout(self, commit_id: str, paths: list = None) -> str:
+        return self.run("checkout", commit_id, "--", *paths) if paths else self.run("checkout", commit_id)
+
+    def branch(self, name: str) -> str:
+        return self.run("branch", name)
+
+    def merge(self, branch_name: str) -> str:
+        return self.run("merge", branch_name)
+
+    def log(self, *options) -> str:
+        return self.run("log", *options)
+
+
+def get_option(argvs: list, name: str, default=None):
+    if name in argvs and argvs.index(name) + 1 < len(argvs):
+        return argvs[argvs.index(name) + 1]
+    return default
+
+
+def run_command(argvs: list) -> None:
+    """Run one command line, argvs like sys.argv, in the repository of the working directory."""
+    wit_path = find_wit_dir(Path.cwd().absolute())
+    if wit_path is not None:
+        use_repository(wit_path)
+    if argvs[1:2] == ["clone"] and len(argvs) >= 3:
+        clone(argvs[2], None if get_option(argvs, "--depth") is None else int(get_option(argvs, "--depth")))  # clone PATH [--depth N]
+    elif argvs[1:2] == ["fetch"]:
+        fetch(None if get_option(argvs, "--depth") is None else int(get_option(argvs, "--depth")))  # fetch [--depth N]
+    elif argvs[1:2] == ["upload-pack"]:
+        upload_pack(argvs[2] if len(argvs) > 2 else "")  # remote side of fetch and clone
+    elif argvs[1:2] == ["diff"]:
+        options = argvs[2:argvs.index("--")] if "--" in argvs else argvs[2:]
+        paths = argvs[argvs.index("--") + 1:] if "--" in argvs else []
+        diff([option for option in options if not option.startswith("--")], paths, "--cached" in options, "--stat" in options)  # diff [--cached] [--stat] [A [B]] [-- paths]
+    elif argvs[1:2] == ["fsck"]:
+        fsck("--resume" in argvs)  # fsck [--resume]
+    elif argvs[1:2] == ["checkout"] and argvs[3:4] == ["--"]:
+        checkout_paths(argvs[2], argvs[4:])  # checkout <id> -- <paths>
+    elif argvs[1:2] == ["sparse"] and len(argvs) >= 3:
+        sparse(argvs[2], argvs[3:])  # sparse set <paths> / list / disable
+    elif argvs[1:2] == ["log"]:
+        limit = get_option(argvs, "--limit")
+        show_log("--graph" in argvs, None if limit is None else int(limit), int(get_option(argvs, "--skip", 0)), "--oneline" in argvs)  # log [--graph] [--oneline] [--limit N] [--skip N]
+    elif len(argvs) == 2:
         if argvs[1] == "init":
             init()
         elif argvs[1] == "status":
             status()
         elif argvs[1] == "graph":
             graph()
+        elif argvs[1] == "migrate":
+            migrate()
+        elif argvs[1] == "gc":
+            gc()
+        elif argvs[1] == "repack":
+            repack()
+        elif argvs[1] == "push":
+            push()
+        elif argvs[1] == "receive-pack":
+            receive_pack()  # remote side of push
+        elif argvs[1] == "batch":
+            batch()
     elif len(argvs) == 3:
         if argvs[1] == "add":
             add(argvs[2])  # The path to add
@@ -580,4 +3231,25 @@ if __name__ == "__main__":
         elif argvs[1] == "branch":
             branch(argvs[2])  # NAME
         elif argvs[1] == "merge":
-            merge(argvs[2])  # branch name
\ No newline at end of file
+            merge(argvs[2])  # branch name
+        elif argvs[1] == "daemon":
+            daemon(argvs[2])  # start / stop / run (foreground)
+    elif len(argvs) == 4:
+        if argvs[1] == "config":
+            config(argvs[2], argvs[3])  # KEY VALUE, ex. snapshot hardlink
+        elif argvs[1] == "graph" and argvs[2] == "--output":
+            graph(argvs[3])  # export to an image file, ex. graph.svg
+
+
+if __name__ == "__main__":
+    argvs = sys.argv
+    if "--profile" in argvs or os.environ.get("WIT_TRACE"):  # --profile [--profile-output FILE], WIT_TRACE=1 / FILE
+        trace_output = get_option(argvs, "--profile-output", os.environ.get("WIT_TRACE") if os.environ.get("WIT_TRACE") not in (None, "1") else None)
+        if "--profile-output" in argvs:
+            del argvs[argvs.index("--profile-output"):argvs.index("--profile-output") + 2]
+        if "--profile" in argvs:
+            argvs.remove("--profile")
+        start_trace(trace_output)
+    if argvs[1:2] not in (["upload-pack"], ["receive-pack"]):  # their stdout is the protocol
+        print(argvs)
+    run_command(argvs)